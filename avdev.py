@@ -0,0 +1,256 @@
+import asyncio
+import inspect
+import logging
+import threading
+
+import paho.mqtt.client as mqtt
+
+import latency
+import trafficgen
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMqttConnection:
+    # Drives a paho client from an asyncio event loop through paho's
+    # external socket hooks. The loop calls loop_read/loop_write when the
+    # socket is ready and loop_misc once a second; no network thread is
+    # started. A lost connection is reconnected with exponential backoff
+    # (like paho's loop_forever) and on_connected() is called after every
+    # CONNACK, so subscriptions can be made again.
+
+    RECONNECT_MIN_DELAY = 1
+    RECONNECT_MAX_DELAY = 120
+
+    def __init__(self, client, loop, latency=None, on_connected=None):
+        self.client = client
+        self.loop = loop
+        self.latency = latency
+        self.on_connected = on_connected
+        self.loop_thread = threading.get_ident()
+        self.misc_task = None
+        self.reconnect_task = None
+        self.stopping = False
+        self.reconnects = 0
+        self.connected = loop.create_future()
+        self.disconnected = None
+
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+        client.on_connect = self.mqtt_on_connect
+        client.on_disconnect = self.mqtt_on_disconnect
+        client.on_publish = self.mqtt_on_publish
+
+    def _call_in_loop(self, func, *args):
+        # paho may publish from other threads (e.g. crypto offload) and
+        # reconnect() runs in an executor
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._call_in_loop(self._socket_opened, sock)
+
+    def _socket_opened(self, sock):
+        self.loop.add_reader(sock, self.client.loop_read)
+        if self.misc_task is None or self.misc_task.done():
+            self.misc_task = self.loop.create_task(self._misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self._call_in_loop(self._socket_closed, sock)
+
+    def _socket_closed(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc_task:
+            self.misc_task.cancel()
+            self.misc_task = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._call_in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._call_in_loop(self.loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        if not self.connected.done():
+            if rc == 0:
+                self.connected.set_result(True)
+            else:
+                self.connected.set_exception(ConnectionError(mqtt.connack_string(rc)))
+        if rc == 0 and self.on_connected:
+            self.on_connected(client)
+
+    def mqtt_on_disconnect(self, client, userdata, rc):
+        if self.stopping:
+            if self.disconnected and not self.disconnected.done():
+                self.disconnected.set_result(rc)
+            return
+        logger.warning('Connection lost (rc={}), reconnecting'.format(rc))
+        self._call_in_loop(self._start_reconnect)
+
+    def mqtt_on_publish(self, client, userdata, mid):
+        if self.latency:
+            self.latency.ack(mid)
+
+    def _start_reconnect(self):
+        if self.reconnect_task is None and not self.stopping:
+            self.reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.RECONNECT_MIN_DELAY
+        try:
+            while not self.stopping:
+                await asyncio.sleep(delay)
+                try:
+                    # Blocking TCP connect, the CONNACK arrives through the loop
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    self.reconnects += 1
+                    return
+                except OSError as e:
+                    logger.warning('Reconnect failed: {}'.format(e))
+                    delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+        finally:
+            self.reconnect_task = None
+
+    async def connect(self, host, port, keepalive=60):
+        self.client.connect(host, port, keepalive)
+        await self.connected
+
+    async def disconnect(self, timeout=2):
+        self.stopping = True
+        if self.reconnect_task:
+            self.reconnect_task.cancel()
+        self.disconnected = self.loop.create_future()
+        if self.client.disconnect() != mqtt.MQTT_ERR_SUCCESS:
+            return
+        try:
+            await asyncio.wait_for(self.disconnected, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+class AsyncVdevRuntime:
+    # Runs any number of Vdev instances on one event loop and one MQTT
+    # connection: receiving, routing by device-id, and txmodule streams as
+    # tasks instead of threads. Stream functions may be plain generators
+    # (as used with TrafficGen) or async generators.
+
+    def __init__(self, devices, plat_dic, tx_script=None, track_latency=False):
+        self.devices = dict((dev.get_deviceid(), dev) for dev in devices)
+        self.plat_dic = plat_dic
+        self.gen_functions = []
+        if tx_script:
+            self.gen_functions = trafficgen.load_gen_functions(tx_script)
+        self.tasks = []
+        self.connection = None
+
+        # One publish latency tracker for the shared connection
+        self.latency = None
+        if track_latency:
+            self.latency = latency.PublishLatency()
+            for dev in devices:
+                dev.set_latency_tracker(self.latency)
+
+    def get_p2d_topic(self):
+        # One subscription for all subscribing devices
+        subscribers = [dev for dev in self.devices.values() if dev.enable_subscribe]
+        if not subscribers:
+            return None
+        if len(subscribers) == 1:
+            return subscribers[0].get_p2d_topic()
+        return '/+/' + subscribers[0].get_p2d_topic().split('/')[2]
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        client = mqtt.Client()
+        client.on_message = self.mqtt_on_message
+        self.connection = AsyncMqttConnection(client, loop, self.latency, self.mqtt_on_connected)
+
+        mqtt_info = self.plat_dic['mqtt']
+        user, password = mqtt_info['user'], mqtt_info['pass']
+        if user:
+            client.username_pw_set(user, password)
+
+        for dev in self.devices.values():
+            dev.attach_client(client)
+
+        host, port = mqtt_info['host'], mqtt_info['port']
+        await self.connection.connect(host, port)
+        logger.info("Connect to {}:{} ({} devices)".format(host, port, len(self.devices)))
+
+        for dev in self.devices.values():
+            if not dev.enable_subscribe and dev.on_connect_tx_message:
+                dev.process_platform_message("", dev.on_connect_tx_message)
+
+    def mqtt_on_connected(self, client):
+        # After connect and every reconnect
+        topic = self.get_p2d_topic()
+        if topic:
+            client.subscribe(topic)
+            logger.info("Subscribe to " + topic)
+
+    def mqtt_on_message(self, client, userdata, msg):
+        parts = msg.topic.split('/')
+        dev = self.devices.get(parts[1]) if len(parts) == 3 else None
+        if dev:
+            dev.mqtt_on_message(client, userdata, msg)
+
+    async def run_stream(self, dev, gen_function):
+        # Same semantics as StreamRunner: the generator is restarted when it
+        # ends and an empty data dict stops the stream.
+        user_data = {}
+        type_dic = dev.device_schema.new_type_dict()
+        while not dev.is_stopped():
+            if inspect.isasyncgenfunction(gen_function):
+                stream = gen_function(type_dic, user_data)
+            else:
+                stream = _iterate(gen_function(type_dic, user_data))
+
+            async for data, delay in stream:
+                if not data or dev.is_stopped():
+                    return
+                if delay >= 0:
+                    await asyncio.sleep(delay)
+                dev.send_to_platform(data)
+
+    async def run(self, stop_event=None):
+        # Runs until stop_event is set or the task is cancelled
+        stop_event = stop_event or asyncio.Event()
+        await self.connect()
+
+        for dev in self.devices.values():
+            for func in self.gen_functions:
+                self.tasks.append(asyncio.ensure_future(self.run_stream(dev, func)))
+
+        try:
+            await stop_event.wait()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        for dev in self.devices.values():
+            dev.stop()
+
+        if self.connection:
+            await self.connection.disconnect()
+
+
+async def _iterate(iterable):
+    for item in iterable:
+        yield item
@@ -0,0 +1,138 @@
+#! /usr/bin/python3
+# Microbenchmarks for VDev message handling paths.
+#
+#   python benchmark.py            (run all)
+#   python benchmark.py codec validate  (run selected)
+#
+import argparse
+import base64
+import json
+import timeit
+
+import pyDes
+from devschema import compile_schema
+from vdev import validate_data_list
+from wirecodec import WireCodec
+
+
+def report(name, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=3))
+    per_call = best / number
+    print('  {:<32} {:>10.2f} us/msg {:>10.0f} msg/s'.format(name, per_call * 1e6, 1 / per_call))
+    return per_call
+
+
+def bench_codec(number):
+    des = pyDes.des('EFEFDE23', pyDes.ECB, padmode=pyDes.PAD_PKCS5)
+    codec = WireCodec(des)
+
+    for fields in (4, 32):
+        data_dic = {'data': [dict(('f_str{}'.format(i), 'value {}'.format(i)) for i in range(fields))]}
+        jdata = json.dumps(data_dic)
+        payload = codec.encode_text(jdata)
+        print('codec: {} fields, {} byte json'.format(fields, len(jdata)))
+
+        def old_encode():
+            return base64.b64encode(des.encrypt(json.dumps(data_dic)))
+
+        def new_encode():
+            return codec.encode_text(json.dumps(data_dic))
+
+        def old_decode():
+            return json.loads(des.decrypt(base64.b64decode(payload)).decode('utf-8'))
+
+        def new_decode():
+            return json.loads(codec.decode_text(payload))
+
+        assert old_encode() == new_encode() and old_decode() == new_decode()
+
+        old = report('encode des.encrypt+b64encode', old_encode, number)
+        new = report('encode WireCodec', new_encode, number)
+        print('  speedup x{:.2f}'.format(old / new))
+        old = report('decode b64decode+des.decrypt', old_decode, number)
+        new = report('decode WireCodec', new_decode, number)
+        print('  speedup x{:.2f}'.format(old / new))
+
+
+def legacy_validate(device_type_dic, data_list):
+    # Per-field checks of Vdev.decode_platform_message before compile_schema
+    for x in data_list:
+        if not isinstance(x, dict):
+            return 'dict'
+        for name, value in x.items():
+            if not name in device_type_dic:
+                return 'name'
+            if value == "?":
+                continue
+            type_str = device_type_dic[name]['type']
+            items = device_type_dic[name]['items']
+            if type_str=='Boolean' and not isinstance(value, bool):
+                return 'Boolean'
+            if type_str=='String' and not isinstance(value, str):
+                return 'String'
+            if type_str=='Number' and not isinstance(value, (int, float)):
+                return 'Number'
+            if type_str=='Enum' and not value in items:
+                return 'Enum'
+    return None
+
+
+def bench_validate(number):
+    enum_items = ['state{}'.format(i) for i in range(32)]
+    device_type_dic = {
+        'f_bool': {'type':'Boolean', 'items':['WHAT?']},
+        'f_num': {'type':'Number', 'items':['WHAT?']},
+        'f_str': {'type':'String', 'items':['WHAT?']},
+        'f_enum': {'type':'Enum', 'items':enum_items},
+    }
+    schema = compile_schema(device_type_dic)
+
+    for entries in (10, 1000):
+        data_list = [
+            {'f_bool':i % 2 == 0, 'f_num':i, 'f_str':'v', 'f_enum':enum_items[i % 32]}
+            for i in range(entries)]
+        print('validate: data list with {} entries'.format(entries))
+
+        assert legacy_validate(device_type_dic, data_list) is None
+        assert validate_data_list(schema, data_list) is None
+
+        n = max(1, number * 10 // entries)
+        old = report('legacy checks', lambda: legacy_validate(device_type_dic, data_list), n)
+        new = report('compiled schema', lambda: validate_data_list(schema, data_list), n)
+        print('  speedup x{:.2f}'.format(old / new))
+
+
+def bench_serialize(number):
+    # Response serialization cost by number of attributes. A schema-specialized
+    # serializer (pre-encoded keys, cached per-type encoders) was not faster
+    # than json.dumps (x0.7-x0.9 for 50 and 500 fields) and was not added.
+    values = (lambda i: i % 3 == 0, lambda i: i * 1.5 if i % 8 == 1 else i,
+        lambda i: 'value {}'.format(i), lambda i: 'enum{}'.format(i % 3 + 1))
+
+    for fields in (4, 50, 500):
+        data_dic = {'data': [dict(('f_{}'.format(i), values[i % 4](i)) for i in range(fields))]}
+        print('serialize: {} fields, {} byte json'.format(fields, len(json.dumps(data_dic))))
+
+        n = max(1, number * 20 // fields)
+        report('json.dumps', lambda: json.dumps(data_dic), n)
+
+
+BENCHMARKS = {
+    'codec': bench_codec,
+    'validate': bench_validate,
+    'serialize': bench_serialize,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VDev microbenchmarks')
+    parser.add_argument('names', metavar='name', nargs='*',
+        help='Benchmarks to run: {}. Default=all'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('-n', dest='number', type=int, default=500,
+        help='Calls per timing run. Default=500')
+    args = parser.parse_args()
+
+    for name in args.names or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark "{}"'.format(name))
+        BENCHMARKS[name](args.number)
@@ -0,0 +1,169 @@
+import heapq
+import json
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingPublisher:
+    # Publishes txmodule data from a TrafficGen queue, merging everything
+    # that arrives within window seconds of the first item into one
+    # {"data": [...]} message (last value of a field wins). A message is
+    # sent earlier when its JSON size would exceed max_payload bytes; the
+    # item that doesn't fit starts the next message.
+
+    def __init__(self, dev, window=0.1, max_payload=4096):
+        self.dev = dev
+        self.window = window
+        self.max_payload = max_payload
+        self.pending = None
+
+        self.lock = threading.Lock()
+        self.items = 0
+        self.messages = 0
+        self.overwritten = 0
+
+    @staticmethod
+    def _field_size(name, value):
+        # Size of '"name": value, ' in the JSON message
+        return len(json.dumps(name)) + len(json.dumps(value)) + 4
+
+    def collect(self, q):
+        # Blocks for the first item, returns the merged data dict
+        first = self.pending if self.pending is not None else q.get()
+        self.pending = None
+
+        merged, sizes = dict(first), {}
+        for name, value in first.items():
+            sizes[name] = self._field_size(name, value)
+        size = sum(sizes.values())
+        items, overwritten = 1, 0
+
+        deadline = time.monotonic() + self.window
+        while True:
+            try:
+                timeout = deadline - time.monotonic()
+                data = q.get(timeout=timeout) if timeout > 0 else q.get_nowait()
+            except queue.Empty:
+                break
+
+            new_size = size
+            new_sizes = {}
+            for name, value in data.items():
+                new_sizes[name] = self._field_size(name, value)
+                new_size += new_sizes[name] - sizes.get(name, 0)
+
+            if new_size > self.max_payload:
+                self.pending = data
+                break
+
+            for name, value in data.items():
+                if name in merged:
+                    overwritten += 1
+                merged[name] = value
+            sizes.update(new_sizes)
+            size = new_size
+            items += 1
+
+        with self.lock:
+            self.items += items
+            self.messages += 1
+            self.overwritten += overwritten
+        return merged
+
+    def run(self, q):
+        while not self.dev.is_stopped():
+            data = self.collect(q)
+            self.dev.wait_for_publish_window()
+            self.dev.send_to_platform(data)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'items':self.items,
+                'messages':self.messages,
+                'messages_saved':self.items - self.messages,
+                'fields_overwritten':self.overwritten,
+            }
+
+
+class _Scheduler(threading.Thread):
+    # One timer thread for all devices, instead of a Timer thread per burst
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.cond = threading.Condition()
+        self.calls = []
+        self.seq = 0
+
+    def call_later(self, delay, func):
+        with self.cond:
+            self.seq += 1
+            heapq.heappush(self.calls, (time.monotonic() + delay, self.seq, func))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.calls or self.calls[0][0] > time.monotonic():
+                    self.cond.wait(self.calls[0][0] - time.monotonic() if self.calls else None)
+                _, _, func = heapq.heappop(self.calls)
+            try:
+                func()
+            except Exception:
+                logger.exception('Scheduled call failed')
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def call_later(delay, func):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = _Scheduler()
+            _scheduler.start()
+    _scheduler.call_later(delay, func)
+
+
+class ReadCoalescer:
+    # Subscribe mode: read-requests arriving within window seconds of the
+    # first one are answered with one response, holding the union of the
+    # requested fields with the values at the end of the window.
+
+    def __init__(self, window, respond):
+        self.window = window
+        self.respond = respond
+        self.lock = threading.Lock()
+        self.pending = None
+        self.requests = 0
+        self.responses = 0
+
+    def add(self, read_request):
+        with self.lock:
+            self.requests += 1
+            if self.pending is not None:
+                self.pending.update(read_request)
+                return
+            self.pending = set(read_request)
+        call_later(self.window, self.flush)
+
+    def flush(self):
+        with self.lock:
+            read_request, self.pending = self.pending, None
+            if read_request is None:
+                return
+            self.responses += 1
+        self.respond(read_request)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'requests':self.requests,
+                'responses':self.responses,
+                'responses_saved':self.requests - self.responses,
+            }
@@ -0,0 +1,117 @@
+import binascii
+import concurrent.futures
+import logging
+import queue
+import threading
+
+import wirecodec
+
+
+logger = logging.getLogger(__name__)
+
+
+# Codec per key in the worker process
+_worker_codecs = {}
+
+
+def _process_batch(items):
+    # Runs in the worker process. Returns (result, error) per item.
+    results = []
+    for kind, key, data in items:
+        codec = _worker_codecs.get(key)
+        if codec is None:
+            codec = _worker_codecs[key] = wirecodec.WireCodec(wirecodec.get_shared_cipher(key))
+        try:
+            if kind == CryptoOffload.DECODE:
+                results.append((codec.decode_text(data), None))
+            else:
+                results.append((codec.encode_text(data), None))
+        except (ValueError, binascii.Error) as e:
+            results.append((None, str(e)))
+    return results
+
+
+class CryptoOffload:
+    # Runs WireCodec encode/decode in a process pool so crypto scales with
+    # cores and the MQTT network thread is never blocked by DES.
+    #
+    # Items are queued in submission order and sent to the workers in
+    # batches, to amortize the IPC cost. Callbacks run on a single
+    # completion thread in submission order, which keeps the message order
+    # of every device. Each item carries its DES key, so devices with
+    # different keys can share one pool.
+
+    DECODE = 'dec'
+    ENCODE = 'enc'
+    READY = 'ready'     # Result already known, only keeps the ordering
+
+    def __init__(self, workers, batch_size=64, max_batches=None):
+        self.batch_size = batch_size
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+        self.items = queue.Queue()
+        # Bounds the number of batches in flight, two per worker by default
+        self.batches = queue.Queue(max_batches or workers * 2)
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.completer = threading.Thread(target=self._complete, daemon=True)
+        self.dispatcher.start()
+        self.completer.start()
+
+    def submit(self, kind, key, data, callback):
+        # callback(result, error) is called once the item is processed
+        self.items.put((kind, key, data, callback))
+
+    def _dispatch(self):
+        while True:
+            item = self.items.get()
+            if item is None:
+                self.batches.put(None)
+                return
+
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.items.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.items.put(None)
+                    break
+                batch.append(item)
+
+            work = [(kind, key, data) for kind, key, data, _ in batch if kind != CryptoOffload.READY]
+            future = None
+            if work:
+                future = self.executor.submit(_process_batch, work)
+            self.batches.put((future, batch))
+
+    def _complete(self):
+        while True:
+            entry = self.batches.get()
+            if entry is None:
+                return
+
+            future, batch = entry
+            results = iter(())
+            if future:
+                try:
+                    results = iter(future.result())
+                except Exception as e:
+                    logger.error('Crypto worker failed {}'.format(e))
+                    results = iter([(None, str(e))] * len(batch))
+
+            for kind, _, data, callback in batch:
+                if kind == CryptoOffload.READY:
+                    result, error = data, None
+                else:
+                    result, error = next(results)
+                try:
+                    callback(result, error)
+                except Exception:
+                    logger.exception('Crypto callback failed')
+
+    def shutdown(self):
+        self.items.put(None)
+        self.completer.join()
+        self.executor.shutdown()
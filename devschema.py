@@ -0,0 +1,161 @@
+import collections
+import hashlib
+import json
+import threading
+import types
+
+
+DEFAULT_VALUES = {'Boolean':False, 'String':'-', 'Number':0}
+
+# Optional publish policy of an attribute in "attributeTypes" (see pubpolicy)
+#   deadband      Number, skip changes <= deadband
+#   deadband_rel  Number, skip changes <= deadband_rel * abs(last sent value)
+#   min_interval  seconds between updates of the field
+#   max_silence   resend the last value if not sent for max_silence seconds
+POLICY_KEYS = ('deadband', 'deadband_rel', 'min_interval', 'max_silence')
+NUMBER_POLICY_KEYS = ('deadband', 'deadband_rel')
+
+PublishPolicy = collections.namedtuple('PublishPolicy', POLICY_KEYS)
+
+
+def _compile_field(name, type_str, items):
+    # Returns check(value) -> None if value is valid for the field, otherwise
+    # the error message. "?" (read-request) is accepted for every type.
+    if type_str == 'Boolean':
+        message = 'Expect boolean for "{}" < "{{}}"'.format(name)
+        def check(value):
+            if isinstance(value, bool) or value == '?':
+                return None
+            return message.format(value)
+
+    elif type_str == 'String':
+        message = 'Expect string for "{}" < "{{}}"'.format(name)
+        def check(value):
+            if isinstance(value, str):
+                return None
+            return message.format(value)
+
+    elif type_str == 'Number':
+        message = 'Expect number for "{}" < "{{}}"'.format(name)
+        def check(value):
+            if isinstance(value, (int, float)) or value == '?':
+                return None
+            return message.format(value)
+
+    elif type_str == 'Enum':
+        allowed = frozenset(items)
+        message = 'Invalid value for enum "{}" "{}" < "{{}}"'.format(name, list(items))
+        def check(value):
+            try:
+                if value in allowed or value == '?':
+                    return None
+            except TypeError:
+                # unhashable (list/dict) values
+                pass
+            return message.format(value)
+
+    else:
+        def check(value):
+            return None
+
+    return check
+
+
+def compile_schema(device_type_dic):
+    # device_type_dic {name: {'type':type_str, 'items':items}} -> {name: check}
+    return dict(
+        (name, _compile_field(name, type_def['type'], type_def['items']))
+        for name, type_def in device_type_dic.items())
+
+
+class DeviceSchema:
+    # Immutable description of a device type, built from "attributeTypes" of
+    # device json. Shared by all devices of the type (see get_schema), only
+    # the values are stored per device.
+    #   attribute_types  tuple of {'name', 'type', ...} (enum type is a tuple)
+    #   names            field names in definition order
+    #   index            {name: position in names}
+    #   type_dic         {name: {'type':type_str, 'items':items}}
+    #   enum_sets        {name: frozenset(items)} for Enum fields
+    #   defaults         {name: default value}
+    #   validators       {name: check}, see compile_schema
+    #   policies         {name: PublishPolicy} of fields with a policy
+
+    __slots__ = ('digest', 'attribute_types', 'names', 'index', 'type_dic',
+        'enum_sets', 'defaults', 'validators', 'policies')
+
+    def __init__(self, attribute_types, digest=None):
+        attributes, type_dic, defaults, policies = [], {}, {}, {}
+
+        for type_field in attribute_types:
+            name, data_type = type_field['name'], type_field['type']
+
+            if isinstance(data_type, (list, tuple)):
+                type_str = 'Enum'
+                items = tuple(data_type)
+                data_type = items
+                default = items[0]
+            else:
+                type_str = data_type
+                items = ('WHAT?',)
+                default = DEFAULT_VALUES[type_str]
+
+            attributes.append(types.MappingProxyType(dict(type_field, type=data_type)))
+            type_dic[name] = types.MappingProxyType({'type':type_str, 'items':items})
+            defaults[name] = default
+
+            if any(type_field.get(key) for key in POLICY_KEYS):
+                policies[name] = PublishPolicy(*(type_field.get(key, 0) for key in POLICY_KEYS))
+
+        setattr_ = super().__setattr__
+        setattr_('digest', digest)
+        setattr_('attribute_types', tuple(attributes))
+        setattr_('names', tuple(type_dic))
+        setattr_('index', types.MappingProxyType(dict((name, i) for i, name in enumerate(type_dic))))
+        setattr_('type_dic', types.MappingProxyType(type_dic))
+        setattr_('enum_sets', types.MappingProxyType(dict(
+            (name, frozenset(t['items'])) for name, t in type_dic.items() if t['type'] == 'Enum')))
+        setattr_('defaults', types.MappingProxyType(defaults))
+        setattr_('validators', types.MappingProxyType(compile_schema(type_dic)))
+        setattr_('policies', types.MappingProxyType(policies))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DeviceSchema is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('DeviceSchema is immutable')
+
+    def new_data_dict(self):
+        return dict(self.defaults)
+
+    def new_type_dict(self):
+        # Mutable copy of type_dic with list items, as passed to txmodules
+        return dict((name, {'type':t['type'], 'items':list(t['items'])})
+                    for name, t in self.type_dic.items())
+
+
+def schema_digest(attribute_types):
+    canonical = json.dumps(attribute_types, sort_keys=True, separators=(',', ':'), default=dict)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def get_schema(attribute_types):
+    # Interned DeviceSchema for "attributeTypes": devices loading the same
+    # (by content) device type get the same schema object.
+    digest = schema_digest(attribute_types)
+    schema = _registry.get(digest)
+    if schema is None:
+        with _registry_lock:
+            schema = _registry.get(digest)
+            if schema is None:
+                schema = DeviceSchema(attribute_types, digest)
+                _registry[digest] = schema
+    return schema
+
+
+def registry_size():
+    return len(_registry)
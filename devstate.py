@@ -0,0 +1,324 @@
+import array
+import collections.abc
+import threading
+
+import pipeline
+
+
+# Column-oriented state of all devices of one device type (one StateTable
+# per DeviceSchema). A device only keeps its row number (DeviceState), the
+# values are stored in per-field columns:
+#   Boolean  bitmap
+#   Number   array('d') + bitmap of int values (ints are returned as int, so
+#            JSON output is the same as with a dict)
+#   Enum     array('H') of item index
+#   String   list
+# Values that don't fit the column (e.g. bool in a Number field, ints above
+# 2**53) are kept in a small overflow dict of the table.
+
+MAX_EXACT_INT = 2**53
+
+
+class _Bitmap:
+    __slots__ = ('bits',)
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def grow(self, rows):
+        size = (rows + 7) >> 3
+        if len(self.bits) < size:
+            self.bits.extend(bytes(size - len(self.bits)))
+
+    def test(self, row):
+        return bool(self.bits[row >> 3] & (1 << (row & 7)))
+
+    def put(self, row, flag):
+        if flag:
+            self.bits[row >> 3] |= 1 << (row & 7)
+        else:
+            self.bits[row >> 3] &= ~(1 << (row & 7)) & 0xff
+
+
+class _BoolColumn(_Bitmap):
+    __slots__ = ()
+
+    def get(self, row):
+        return self.test(row)
+
+    def set(self, row, value):
+        if value.__class__ is not bool:
+            return False
+        self.put(row, value)
+        return True
+
+
+class _NumberColumn:
+    __slots__ = ('values', 'is_int')
+
+    def __init__(self):
+        self.values = array.array('d')
+        self.is_int = _Bitmap()
+
+    def grow(self, rows):
+        self.values.extend(array.array('d', [0.0]) * (rows - len(self.values)))
+        self.is_int.grow(rows)
+
+    def get(self, row):
+        value = self.values[row]
+        if self.is_int.test(row):
+            return int(value)
+        return value
+
+    def set(self, row, value):
+        cls = value.__class__
+        if cls is float:
+            self.values[row] = value
+            self.is_int.put(row, False)
+        elif cls is int and -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+            self.values[row] = value
+            self.is_int.put(row, True)
+        else:
+            return False
+        return True
+
+
+class _EnumColumn:
+    __slots__ = ('codes', 'items', 'item_codes')
+
+    def __init__(self, items):
+        self.codes = array.array('H')
+        self.items = items
+        self.item_codes = dict((item, i) for i, item in enumerate(items))
+
+    def grow(self, rows):
+        self.codes.extend(array.array('H', [0]) * (rows - len(self.codes)))
+
+    def get(self, row):
+        return self.items[self.codes[row]]
+
+    def set(self, row, value):
+        if value.__class__ is not str:
+            return False
+        code = self.item_codes.get(value)
+        if code is None:
+            return False
+        self.codes[row] = code
+        return True
+
+
+class _ObjectColumn:
+    __slots__ = ('values',)
+
+    def __init__(self):
+        self.values = []
+
+    def grow(self, rows):
+        self.values.extend([None] * (rows - len(self.values)))
+
+    def get(self, row):
+        return self.values[row]
+
+    def set(self, row, value):
+        self.values[row] = value
+        return True
+
+
+def _make_column(type_def):
+    type_str = type_def['type']
+    if type_str == 'Boolean':
+        return _BoolColumn()
+    if type_str == 'Number':
+        return _NumberColumn()
+    if type_str == 'Enum' and len(type_def['items']) <= 0xffff:
+        return _EnumColumn(type_def['items'])
+    return _ObjectColumn()
+
+
+class StateTable:
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = tuple(_make_column(schema.type_dic[name]) for name in schema.names)
+        self.overflow = {}
+        self.rows = 0
+        self.row_ids = []
+        # Optional mirror of the table, e.g. shmstate.SharedStateExport
+        self.exporter = None
+        # Bitmap bytes are shared by 8 rows and Number columns keep value and
+        # int flag apart, so reads and writes are serialized
+        self.lock = threading.Lock()
+
+    def add_row(self, device_id=None):
+        with self.lock:
+            row = self.rows
+            self.rows += 1
+            self.row_ids.append(device_id)
+            for column in self.columns:
+                column.grow(self.rows)
+
+        for col, name in enumerate(self.schema.names):
+            self.set(row, col, self.schema.defaults[name])
+
+        if self.exporter:
+            with self.lock:
+                self.exporter.write_row(row)
+        return row
+
+    def _get(self, row, col):
+        if self.overflow:
+            value = self.overflow.get((row, col), self)
+            if value is not self:
+                return value
+        return self.columns[col].get(row)
+
+    def get(self, row, col):
+        # Under the lock: a Number value and its int flag are two writes
+        with self.lock:
+            return self._get(row, col)
+
+    def set(self, row, col, value):
+        with self.lock:
+            if self.columns[col].set(row, value):
+                if self.overflow:
+                    self.overflow.pop((row, col), None)
+            else:
+                self.overflow[(row, col)] = value
+
+            if self.exporter:
+                self.exporter.write(row, col, value)
+
+    def get_row(self, row):
+        get = self._get
+        with self.lock:
+            return dict((name, get(row, col)) for col, name in enumerate(self.schema.names))
+
+
+class DeviceState(collections.abc.MutableMapping):
+    # dict-like view of one row of a StateTable. Fields are fixed by the
+    # schema: unknown names raise KeyError and fields can't be deleted.
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __getitem__(self, name):
+        return self.table.get(self.row, self.table.schema.index[name])
+
+    def __setitem__(self, name, value):
+        self.table.set(self.row, self.table.schema.index[name], value)
+
+    def __delitem__(self, name):
+        raise TypeError('Device state fields can not be deleted')
+
+    def __iter__(self):
+        return iter(self.table.schema.names)
+
+    def __len__(self):
+        return len(self.table.schema.names)
+
+    def __contains__(self, name):
+        return name in self.table.schema.index
+
+    def to_dict(self):
+        return self.table.get_row(self.row)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def get_table(schema):
+    # One StateTable per (interned) schema
+    table = _tables.get(schema.digest)
+    if table is None:
+        with _tables_lock:
+            table = _tables.get(schema.digest)
+            if table is None:
+                table = StateTable(schema)
+                _tables[schema.digest] = table
+    return table
+
+
+def new_state(schema, device_id=None):
+    # State of a new device, initialized with the schema defaults
+    table = get_table(schema)
+    return DeviceState(table, table.add_row(device_id))
+
+
+class DeltaTracker:
+    # Fields of a device changed since the last acknowledged publish, as a
+    # bitmask over the schema index. take() returns the fields to send:
+    # changed ones plus those of the last publish not yet acknowledged.
+    # sent() records the MQTTMessageInfo of that publish; it is checked with
+    # is_published() on the next take(), so acks need no per-device routing
+    # of on_publish callbacks.
+    __slots__ = ('dirty', 'unacked', 'info', 'token', 'qos', 'lock')
+
+    def __init__(self, qos=0):
+        self.qos = qos
+        self.dirty = 0
+        self.unacked = 0
+        self.info = None
+        self.token = 0
+        self.lock = threading.Lock()
+
+    def mark(self, col):
+        with self.lock:
+            self.dirty |= 1 << col
+
+    def mark_all(self, count):
+        with self.lock:
+            self.dirty |= (1 << count) - 1
+
+    def take(self):
+        # Returns (mask, token), pass token to sent()
+        with self.lock:
+            if self.info is not None and self.info.is_published():
+                self.unacked = 0
+            mask = self.dirty | self.unacked
+            self.dirty = 0
+            self.unacked = mask
+            self.info = None
+            self.token += 1
+            return mask, self.token
+
+    def suppressed(self, token, mask):
+        # Fields of take() not published on purpose (publish policy)
+        with self.lock:
+            if token == self.token:
+                self.unacked &= ~mask
+
+    def take_fields(self, mask):
+        # Fields published outside of take(), e.g. in a read response. Call
+        # before reading the values, pass the info to sent_fields().
+        with self.lock:
+            self.dirty &= ~mask
+            self.unacked &= ~mask
+
+    def sent_fields(self, mask, info):
+        with self.lock:
+            if not pipeline.is_queued(info, self.qos):
+                self.dirty |= mask
+
+    def sent(self, token, info):
+        # info is None or not queued by paho if the publish failed
+        with self.lock:
+            if not pipeline.is_queued(info, self.qos):
+                self.dirty |= self.unacked
+            elif token == self.token:
+                self.info = info
+
+
+def mask_names(names, mask):
+    return [name for i, name in enumerate(names) if mask >> i & 1]
+
+
+def names_mask(index, names):
+    mask = 0
+    for name in names:
+        mask |= 1 << index[name]
+    return mask
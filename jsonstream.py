@@ -0,0 +1,76 @@
+import json
+from json.decoder import WHITESPACE
+
+
+_decoder = json.JSONDecoder()
+
+
+def _skip(text, pos):
+    return WHITESPACE.match(text, pos).end()
+
+
+def _error(message, text, pos):
+    return json.JSONDecodeError(message, text, pos)
+
+
+def iter_field_items(text, field):
+    # Parses the JSON object in text and yields the elements of its array
+    # "field" one by one (json.loads is not called on the whole message, only
+    # one element is held at a time). A non-array value of field is yielded
+    # as the only element. Other members of the object are parsed and
+    # skipped. Raises json.JSONDecodeError (a ValueError) on invalid JSON, at
+    # the point it is reached, and KeyError if field is missing.
+    raw_decode = _decoder.raw_decode
+    found = False
+
+    pos = _skip(text, 0)
+    if text[pos:pos + 1] != '{':
+        raise _error('Expecting object', text, pos)
+    pos = _skip(text, pos + 1)
+
+    if text[pos:pos + 1] == '}':
+        pos += 1
+    else:
+        while True:
+            if text[pos:pos + 1] != '"':
+                raise _error('Expecting property name enclosed in double quotes', text, pos)
+            key, pos = raw_decode(text, pos)
+            pos = _skip(text, pos)
+            if text[pos:pos + 1] != ':':
+                raise _error("Expecting ':' delimiter", text, pos)
+            pos = _skip(text, pos + 1)
+
+            if key == field and text[pos:pos + 1] == '[':
+                found = True
+                pos = _skip(text, pos + 1)
+                if text[pos:pos + 1] == ']':
+                    pos += 1
+                else:
+                    while True:
+                        item, pos = raw_decode(text, pos)
+                        yield item
+                        pos = _skip(text, pos)
+                        delimiter = text[pos:pos + 1]
+                        pos = _skip(text, pos + 1)
+                        if delimiter == ']':
+                            break
+                        if delimiter != ',':
+                            raise _error("Expecting ',' delimiter", text, pos)
+            else:
+                value, pos = raw_decode(text, pos)
+                if key == field:
+                    found = True
+                    yield value
+
+            pos = _skip(text, pos)
+            delimiter = text[pos:pos + 1]
+            pos = _skip(text, pos + 1)
+            if delimiter == '}':
+                break
+            if delimiter != ',':
+                raise _error("Expecting ',' delimiter", text, pos - 1)
+
+    if _skip(text, pos) != len(text):
+        raise _error('Extra data', text, pos)
+    if not found:
+        raise KeyError(field)
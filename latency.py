@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+
+import pipeline
+
+
+# Reported percentiles: stats key -> percentile
+PERCENTILES = (('p50_ms', 50.0), ('p90_ms', 90.0), ('p99_ms', 99.0), ('p99.9_ms', 99.9))
+
+
+class LatencyHistogram:
+    # HDR-style histogram of latencies in microseconds. Values below
+    # 2**SUB_BITS get their own bucket, above that every power of two is
+    # split into 2**(SUB_BITS-1) buckets, so a reported value is at most
+    # 1/64 above the recorded one. record() is a few integer operations.
+
+    SUB_BITS = 7
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value):
+        if value < (1 << cls.SUB_BITS):
+            return value
+        shift = value.bit_length() - cls.SUB_BITS
+        return (value >> shift) + (shift << (cls.SUB_BITS - 1))
+
+    @classmethod
+    def _highest_value(cls, index):
+        # Highest value that falls into the bucket
+        if index < (1 << cls.SUB_BITS):
+            return index
+        shift = (index >> (cls.SUB_BITS - 1)) - 1
+        mantissa = index - (shift << (cls.SUB_BITS - 1))
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1000000), 0)
+        index = self._index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        # In microseconds, 0 if nothing was recorded
+        if not self.count:
+            return 0
+        rank = max(int(self.count * percent / 100.0 + 0.999999), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._highest_value(index), self.max)
+        return self.max
+
+    def get_stats(self):
+        stats = {
+            'count':self.count,
+            'min_ms':(self.min or 0) / 1000.0,
+            'mean_ms':round(self.total / self.count / 1000.0, 3) if self.count else 0.0,
+        }
+        for key, percent in PERCENTILES:
+            stats[key] = self.percentile(percent) / 1000.0
+        stats['max_ms'] = self.max / 1000.0
+        return stats
+
+
+class PublishLatency:
+    # Time from publish to the on_publish acknowledgement, per device and
+    # QoS. One instance per MQTT connection since mids are only unique on a
+    # connection. sent() gets the MQTTMessageInfo and the monotonic time the
+    # publish started, ack() the mid from the connection's on_publish.
+    # paho may call on_publish before publish() returns the mid, such acks
+    # are kept until sent() of that mid, at most MAX_EARLY of them for
+    # EARLY_TIMEOUT seconds (acks of publishes that were not tracked).
+
+    MAX_EARLY = 1024
+    EARLY_TIMEOUT = 10.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.early = {}
+        self.histograms = {}
+        self.failed = 0
+        self.lost = 0
+        self.unmatched = 0
+
+    def sent(self, info, sent_at, qos, device_id=None):
+        # QoS 1/2 publishes while disconnected are acked after reconnect
+        if not pipeline.is_queued(info, qos):
+            with self.lock:
+                self.failed += 1
+            return
+        with self.lock:
+            acked_at = self.early.pop(info.mid, None)
+            if acked_at is not None and acked_at >= sent_at:
+                self._record(device_id, qos, acked_at - sent_at)
+                return
+            if self.pending.get(info.mid) is not None:
+                # mid wrapped around, the old message was never acknowledged
+                self.lost += 1
+            self.pending[info.mid] = (sent_at, qos, device_id)
+
+    def ack(self, mid):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.pending.pop(mid, None)
+            if entry is None:
+                if len(self.early) >= self.MAX_EARLY:
+                    self._expire_early(now)
+                self.early[mid] = now
+                return
+            sent_at, qos, device_id = entry
+            self._record(device_id, qos, now - sent_at)
+
+    def _expire_early(self, now):
+        for mid, acked_at in list(self.early.items()):
+            if now - acked_at > self.EARLY_TIMEOUT:
+                del self.early[mid]
+                self.unmatched += 1
+        # Still full: drop the oldest
+        while len(self.early) >= self.MAX_EARLY:
+            del self.early[next(iter(self.early))]
+            self.unmatched += 1
+
+    def _record(self, device_id, qos, seconds):
+        histogram = self.histograms.get((device_id, qos))
+        if histogram is None:
+            histogram = self.histograms[(device_id, qos)] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def get_device_stats(self, device_id):
+        # {'qos<N>': stats} of one device
+        with self.lock:
+            return dict(('qos{}'.format(qos), histogram.get_stats())
+                        for (dev_id, qos), histogram in self.histograms.items()
+                        if dev_id == device_id)
+
+    def merge_by_qos(self, into=None):
+        # {qos: LatencyHistogram} of all devices, merged into `into`
+        into = {} if into is None else into
+        with self.lock:
+            for (device_id, qos), histogram in self.histograms.items():
+                into.setdefault(qos, LatencyHistogram()).merge(histogram)
+        return into
+
+    def get_stats(self):
+        with self.lock:
+            pending, failed, lost, unmatched = len(self.pending), self.failed, self.lost, self.unmatched
+        stats = dict(('qos{}'.format(qos), histogram.get_stats())
+                     for qos, histogram in sorted(self.merge_by_qos().items()))
+        stats.update(pending=pending, failed=failed, lost=lost, unmatched=unmatched)
+        return stats
+
+    def dump(self, f):
+        # All histograms as JSON lines, one per device and QoS
+        with self.lock:
+            items = sorted(self.histograms.items(), key=lambda item: (str(item[0][0]), item[0][1]))
+            for (device_id, qos), histogram in items:
+                record = {'device':device_id, 'qos':qos}
+                record.update(histogram.get_stats())
+                f.write(json.dumps(record) + '\n')
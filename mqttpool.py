@@ -0,0 +1,129 @@
+import paho.mqtt.client as mqtt
+import logging
+import threading
+import time
+import zlib
+
+import latency
+import pipeline
+
+
+logger = logging.getLogger(__name__)
+
+
+class PoolConnection:
+    # One paho client of an MqttPool. Devices publish through it like
+    # through a mqtt.Client; publish/ack/receive counters are kept here.
+
+    def __init__(self, index, on_message, subscribe_batch, track_latency=False):
+        self.index = index
+        self.subscribe_batch = subscribe_batch
+        self.topics = []
+        self.on_message = on_message
+
+        self.lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+        self.acked = 0
+        self.received = 0
+        self.start_time = time.monotonic()
+        self.latency = latency.PublishLatency() if track_latency else None
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self.mqtt_on_connect
+        self.client.on_message = self.mqtt_on_message
+        self.client.on_publish = self.mqtt_on_publish
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        info = self.client.publish(topic, payload, qos, retain)
+        # Only publishes paho will deliver are acked later
+        with self.lock:
+            if pipeline.is_queued(info, qos):
+                self.published += 1
+            else:
+                self.failed += 1
+        return info
+
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        # Send the subscriptions in batches, one SUBSCRIBE packet per batch
+        for i in range(0, len(self.topics), self.subscribe_batch):
+            batch = self.topics[i:i + self.subscribe_batch]
+            client.subscribe([(topic, 0) for topic in batch])
+        logger.info('Connection {}: subscribe to {} topics'.format(self.index, len(self.topics)))
+
+    def mqtt_on_publish(self, client, userdata, mid):
+        with self.lock:
+            self.acked += 1
+        if self.latency:
+            self.latency.ack(mid)
+
+    def mqtt_on_message(self, client, userdata, msg):
+        with self.lock:
+            self.received += 1
+        self.on_message(self, userdata, msg)
+
+    def get_stats(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            return dict(connection=self.index,
+                        topics=len(self.topics),
+                        published=self.published,
+                        failed=self.failed,
+                        acked=self.acked,
+                        in_flight=self.published - self.acked,
+                        received=self.received,
+                        publish_rate=self.published / elapsed,
+                        receive_rate=self.received / elapsed)
+
+
+class MqttPool:
+    # Shards devices over a fixed number of MQTT connections. A device is
+    # mapped to a connection by a stable hash of its device-id, so it
+    # always publishes and subscribes on the same connection.
+
+    def __init__(self, plat_dic, connections, on_message, subscribe_batch=100, track_latency=False):
+        self.plat_dic = plat_dic
+        self.connections = [PoolConnection(i, on_message, subscribe_batch, track_latency)
+                            for i in range(connections)]
+
+    def get_connection(self, device_id):
+        index = zlib.crc32(device_id.encode('utf-8')) % len(self.connections)
+        return self.connections[index]
+
+    def subscribe(self, device_id, topic):
+        # Subscribed (again) whenever the connection is established
+        self.get_connection(device_id).topics.append(topic)
+
+    def subscribe_all(self, topic):
+        for conn in self.connections:
+            conn.topics.append(topic)
+
+    def connect(self):
+        mqtt_info = self.plat_dic['mqtt']
+        user, password = mqtt_info['user'], mqtt_info['pass']
+        host, port = mqtt_info['host'], mqtt_info['port']
+
+        for conn in self.connections:
+            if user:
+                conn.client.username_pw_set(user, password)
+            conn.client.connect(host, port, 60)
+            conn.client.loop_start()
+
+        logger.info("Connect to {}:{} with {} connections".format(host, port, len(self.connections)))
+
+    def disconnect(self):
+        for conn in self.connections:
+            conn.client.disconnect()
+            conn.client.loop_stop()
+
+    def get_stats(self):
+        return [conn.get_stats() for conn in self.connections]
+
+    def get_latency_stats(self):
+        # Publish latency of all connections, per QoS
+        merged = {}
+        for conn in self.connections:
+            if conn.latency:
+                conn.latency.merge_by_qos(merged)
+        return dict(('qos{}'.format(qos), histogram.get_stats())
+                    for qos, histogram in sorted(merged.items()))
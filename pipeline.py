@@ -0,0 +1,185 @@
+import collections
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+def is_queued(info, qos):
+    # True if paho will deliver the message of a publish. A QoS 1/2 publish
+    # while disconnected returns MQTT_ERR_NO_CONN, but paho keeps the message
+    # and sends it after reconnect (on_publish follows the PUBACK/PUBCOMP).
+    if info is None:
+        return False
+    return info.rc == mqtt.MQTT_ERR_SUCCESS or (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN)
+
+
+class BoundedDataQueue:
+    # Queue of generated data dicts between TrafficGen streams and the
+    # publisher, with at most maxsize items. When full, put() follows the
+    # overflow policy:
+    #   block        wait for free space (slows down the generators)
+    #   drop-oldest  drop the oldest queued item
+    #   drop-newest  drop the new item
+    #   coalesce     merge the new item into the newest queued one
+    #                (last value of a field wins)
+    # get/get_nowait/Empty are the same as queue.Queue.
+
+    def __init__(self, maxsize, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overflow policy "{}"'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.puts = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+    def put(self, data):
+        with self.cond:
+            self.puts += 1
+            if len(self.items) >= self.maxsize:
+                if self.policy == BLOCK:
+                    self.blocked += 1
+                    while len(self.items) >= self.maxsize and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                elif self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                else:
+                    merged = dict(self.items[-1])
+                    merged.update(data)
+                    self.items[-1] = merged
+                    self.coalesced += 1
+                    return
+
+            self.items.append(data)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            if not block:
+                timeout = 0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.items:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.cond.wait(remaining)
+
+            data = self.items.popleft()
+            self.cond.notify_all()
+            return data
+
+    def close(self):
+        # Releases generators blocked in put()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return len(self.items)
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'depth':len(self.items),
+                'max_depth':self.max_depth,
+                'puts':self.puts,
+                'dropped':self.dropped,
+                'coalesced':self.coalesced,
+                'blocked':self.blocked,
+            }
+
+
+class InflightWindow:
+    # Limits the number of published but not yet acknowledged messages of a
+    # device. track() gets the MQTTMessageInfo of each publish, ack() the mid
+    # from on_publish. paho calls on_publish before it marks the info as
+    # published and a shared connection may not pass on_publish to the
+    # device, so wait() also checks is_published() of the tracked infos.
+    # QoS 1/2 messages queued by paho while disconnected count as in flight.
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, max_inflight, qos=0):
+        self.max_inflight = max_inflight
+        self.qos = qos
+        self.inflight = {}
+        self.cond = threading.Condition()
+
+        self.published = 0
+        self.acked = 0
+        self.waits = 0
+        self.max_seen = 0
+
+    def track(self, info):
+        if not is_queued(info, self.qos):
+            return
+        with self.cond:
+            self.published += 1
+            if not info.is_published():
+                self.inflight[info.mid] = info
+                self.max_seen = max(self.max_seen, len(self.inflight))
+
+    def ack(self, mid):
+        with self.cond:
+            if self.inflight.pop(mid, None) is not None:
+                self.acked += 1
+                self.cond.notify_all()
+
+    def _purge(self):
+        for mid, info in list(self.inflight.items()):
+            if info.is_published():
+                del self.inflight[mid]
+                self.acked += 1
+
+    def wait(self, timeout=None):
+        # Blocks while the window is full. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            if len(self.inflight) < self.max_inflight:
+                return True
+            self.waits += 1
+            while True:
+                self._purge()
+                if len(self.inflight) < self.max_inflight:
+                    return True
+                wait = self.POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                self.cond.wait(wait)
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'inflight':len(self.inflight),
+                'max_inflight':self.max_seen,
+                'published':self.published,
+                'acked':self.acked,
+                'window_waits':self.waits,
+            }
@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class PolicyFilter:
+    # Applies the publish policies of a schema (devschema.PublishPolicy) to
+    # outbound data of one device. Fields without a policy always pass.
+    #
+    #   deadband/deadband_rel  Number changes within the deadband of the last
+    #                          sent value are suppressed
+    #   min_interval           updates within min_interval of the last sent
+    #                          one are held back, the latest held value is
+    #                          sent when the interval is over (see due())
+    #   max_silence            the last sent value is sent again when the
+    #                          field was silent for max_silence (see due())
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.last = {}
+        self.held = {}
+        self.lock = threading.Lock()
+
+        self.sent = 0
+        self.suppressed_deadband = 0
+        self.suppressed_interval = 0
+        self.delayed = 0
+        self.heartbeats = 0
+
+        intervals = [t for p in policies.values() for t in (p.min_interval, p.max_silence) if t]
+        # Period of due() checks, 0 if not needed
+        self.tick = min(intervals) / 2 if intervals else 0
+
+    def _in_deadband(self, policy, value, last):
+        if value.__class__ not in (int, float) or last.__class__ not in (int, float):
+            return False
+        threshold = max(policy.deadband, policy.deadband_rel * abs(last))
+        return threshold > 0 and abs(value - last) <= threshold
+
+    def filter(self, data, now=None):
+        # Returns the fields of data dict that should be sent now
+        now = time.monotonic() if now is None else now
+        ret = {}
+        with self.lock:
+            for name, value in data.items():
+                policy = self.policies.get(name)
+                if policy is None:
+                    ret[name] = value
+                    continue
+
+                last = self.last.get(name)
+                if last is not None:
+                    last_value, last_time = last
+                    silent = now - last_time
+
+                    if not (policy.max_silence and silent >= policy.max_silence):
+                        if self._in_deadband(policy, value, last_value):
+                            self.suppressed_deadband += 1
+                            self.held.pop(name, None)
+                            continue
+
+                        if policy.min_interval and silent < policy.min_interval:
+                            self.suppressed_interval += 1
+                            self.held[name] = value
+                            continue
+
+                self.held.pop(name, None)
+                self.last[name] = (value, now)
+                self.sent += 1
+                ret[name] = value
+        return ret
+
+    def due(self, now=None):
+        # Fields to send without new data: held values whose min_interval is
+        # over and heartbeats of fields silent for max_silence
+        now = time.monotonic() if now is None else now
+        ret = {}
+        with self.lock:
+            for name, value in list(self.held.items()):
+                if now - self.last[name][1] >= self.policies[name].min_interval:
+                    del self.held[name]
+                    self.last[name] = (value, now)
+                    self.delayed += 1
+                    ret[name] = value
+
+            for name, (value, last_time) in self.last.items():
+                max_silence = self.policies[name].max_silence
+                if name not in ret and max_silence and now - last_time >= max_silence:
+                    self.last[name] = (value, now)
+                    self.heartbeats += 1
+                    ret[name] = value
+        return ret
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'sent':self.sent,
+                'suppressed_deadband':self.suppressed_deadband,
+                'suppressed_interval':self.suppressed_interval,
+                'delayed':self.delayed,
+                'heartbeats':self.heartbeats,
+            }
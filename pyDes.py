@@ -60,6 +60,13 @@ pad     -> Optional argument. Only when using padmode of PAD_NORMAL. For
 padmode -> Optional argument, set the padding mode, must be one of PAD_NORMAL
 	   or PAD_PKCS5). Defaults to PAD_NORMAL.
 	  
+encrypt_many(data_list, [pad], [padmode])
+decrypt_many(data_list, [pad], [padmode])
+
+data_list -> Sequence of bytes, each entry is encrypted/decrypted as with
+	   encrypt()/decrypt(). In ECB mode all blocks are crypted as one
+	   batch, vectorized with numpy when it is installed.
+
 
 Example
 -------
@@ -76,15 +83,39 @@ print "Decrypted: %r" % k.decrypt(d)
 assert k.decrypt(d, padmode=PAD_PKCS5) == data
 
 
+des.crypt_into(data, out, crypt_type, [iv]) crypts data that is already a
+multiple of 8 bytes into a caller supplied buffer. Cipher objects keep no
+per-call state, so one instance can be used from multiple threads.
+
+encryptor([pad], [padmode]) and decryptor([pad], [padmode]) return a
+crypt_stream for incremental crypting: update(chunk, [out]) for each chunk
+(bytes, bytearray or memoryview) and finalize([out]) to add/remove padding.
+
+Key schedules are cached process wide, so creating many instances with the
+same key is cheap. Use pyDes.key_schedule_cache.resize(n) to change the
+number of cached keys (0 disables caching) and .stats() for hit counters.
+
 See the module source (pyDes.py) for more examples of use.
 You can also run the pyDes.py file without and arguments to see a simple test.
 
 Note: This code was not written for high-end systems needing a fast
       implementation, but rather a handy portable solution with small usage.
+      Blocks are crypted as 64 bit integers using precomputed IP/FP byte
+      tables and combined S-box/P (SP) tables, which keeps it reasonably
+      quick for a pure python implementation.
 
 """
 
+import struct
 import sys
+import threading
+from collections import OrderedDict
+
+try:
+	# Optional, used for vectorized encrypt_many()/decrypt_many()
+	import numpy as _np
+except ImportError:
+	_np = None
 
 # _pythonMajorVersion is used to handle Python2 and Python3 differences.
 _pythonMajorVersion = sys.version_info[0]
@@ -103,6 +134,87 @@ PAD_PKCS5 = 2
 # For a good description of the PKCS5 padding technique, see:
 # http://www.faqs.org/rfcs/rfc1423.html
 
+# Process wide LRU cache of DES key schedules. All des instances created
+# with the same 8 byte key share one immutable set of subkeys, so creating
+# many cipher objects for the same key only runs the key schedule once.
+class _KeyScheduleCache(object):
+	def __init__(self, size):
+		self._size = size
+		self._lock = threading.Lock()
+		self._schedules = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, create_schedule):
+		"""Return the cached schedule for key, calling create_schedule(key) on a miss"""
+		with self._lock:
+			schedule = self._schedules.get(key)
+			if schedule is not None:
+				self.hits += 1
+				# Mark as most recently used
+				del self._schedules[key]
+				self._schedules[key] = schedule
+				return schedule
+			self.misses += 1
+
+		schedule = create_schedule(key)
+		if self._size > 0:
+			with self._lock:
+				self._schedules[key] = schedule
+				while len(self._schedules) > self._size:
+					self._schedules.popitem(last=False)
+		return schedule
+
+	def resize(self, size):
+		"""Set the maximum number of cached key schedules. 0 disables the cache."""
+		with self._lock:
+			self._size = size
+			while len(self._schedules) > size:
+				self._schedules.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._schedules.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self):
+		"""stats() -> dict with size, max_size, hits and misses"""
+		with self._lock:
+			return dict(size=len(self._schedules), max_size=self._size,
+				    hits=self.hits, misses=self.misses)
+
+key_schedule_cache = _KeyScheduleCache(4096)
+
+
+# Bounded cache of crypted ECB blocks for one key, see des.setBlockCache().
+# In ECB mode equal plain blocks always give equal cipher blocks, so for
+# repetitive data most blocks are served by a dictionary lookup.
+class _BlockCache(object):
+	def __init__(self, size):
+		self.size = size
+		self.lock = threading.Lock()
+		self.blocks = ({}, {})	# Indexed by ENCRYPT/DECRYPT
+		self.hits = 0
+		self.misses = 0
+
+	def add(self, table, block, result):
+		# Insert a result, dropping the oldest entries when full
+		with self.lock:
+			while len(table) >= self.size:
+				del table[next(iter(table))]
+			table[block] = result
+
+	def count(self, hits, misses):
+		with self.lock:
+			self.hits += hits
+			self.misses += misses
+
+	def stats(self):
+		with self.lock:
+			return dict(size=len(self.blocks[0]) + len(self.blocks[1]),
+				    max_size=self.size, hits=self.hits, misses=self.misses)
+
 # The base class shared by des and triple des.
 class _baseDes(object):
 	def __init__(self, mode=ECB, IV=None, pad=None, padmode=PAD_NORMAL):
@@ -241,6 +353,88 @@ class _baseDes(object):
 				raise ValueError("pyDes can only work with encoded strings, not Unicode.")
 		return data
 
+	def encrypt_many(self, data_list, pad=None, padmode=None):
+		"""encrypt_many(data_list, [pad], [padmode]) -> list of bytes
+
+		data_list : Sequence of bytes to be encrypted
+		pad  : Optional argument for encryption padding. Must only be one byte
+		padmode : Optional argument for overriding the padding mode.
+
+		Same as calling encrypt() on every entry of data_list. In ECB mode
+		all blocks of all entries are crypted together in one batch, which
+		is vectorized with numpy when it is installed.
+		"""
+		if self.getMode() == CBC:
+			return [self.encrypt(data, pad, padmode) for data in data_list]
+		if pad is not None:
+			pad = self._guardAgainstUnicode(pad)
+		data_list = [self._padData(self._guardAgainstUnicode(data), pad, padmode)
+			     for data in data_list]
+		return self._crypt_many(data_list, des.ENCRYPT)
+
+	def decrypt_many(self, data_list, pad=None, padmode=None):
+		"""decrypt_many(data_list, [pad], [padmode]) -> list of bytes
+
+		data_list : Sequence of bytes to be decrypted
+		pad  : Optional argument for decryption padding. Must only be one byte
+		padmode : Optional argument for overriding the padding mode.
+
+		Same as calling decrypt() on every entry of data_list. In ECB mode
+		all blocks of all entries are crypted together in one batch, which
+		is vectorized with numpy when it is installed.
+		"""
+		if self.getMode() == CBC:
+			return [self.decrypt(data, pad, padmode) for data in data_list]
+		if pad is not None:
+			pad = self._guardAgainstUnicode(pad)
+		data_list = [self._guardAgainstUnicode(data) for data in data_list]
+		for data in data_list:
+			if len(data) % self.block_size != 0:
+				raise ValueError("Invalid data length, data must be a multiple of " + str(self.block_size) + " bytes\n.")
+		data_list = self._crypt_many(data_list, des.DECRYPT)
+		return [self._unpadData(data, pad, padmode) for data in data_list]
+
+	def encryptor(self, pad=None, padmode=None):
+		"""encryptor([pad], [padmode]) -> crypt_stream
+
+		Return a streaming context encrypting data passed in chunks with
+		update(), padding is added by finalize().
+		"""
+		return crypt_stream(self, des.ENCRYPT, pad, padmode)
+
+	def decryptor(self, pad=None, padmode=None):
+		"""decryptor([pad], [padmode]) -> crypt_stream
+
+		Return a streaming context decrypting data passed in chunks with
+		update(), padding is removed by finalize().
+		"""
+		return crypt_stream(self, des.DECRYPT, pad, padmode)
+
+	def _crypt_many(self, data_list, crypt_type):
+		# Crypt the already padded entries of data_list as one ECB buffer
+		data = b''.join(data_list)
+		if not data:
+			return list(data_list)
+		data = self._crypt_ecb_blocks(data, crypt_type)
+
+		result = []
+		pos = 0
+		for entry in data_list:
+			result.append(data[pos:pos + len(entry)])
+			pos += len(entry)
+		return result
+
+	def _crypt_ecb_blocks(self, data, crypt_type):
+		# ECB crypt of a buffer whose length is a multiple of block_size,
+		# running the key stages of des or triple_des over all blocks
+		stages = self._stages[crypt_type]
+		if _np is None:
+			result, _ = des._crypt_blocks(data, stages, crypt_type, None)
+			return struct.pack('>%dQ' % len(result), *result)
+
+		blocks = _np.frombuffer(data, dtype='>u8').astype(_np.uint64)
+		return des._crypt_array(blocks, stages).astype('>u8').tobytes()
+
 #############################################################################
 # 				    DES					    #
 #############################################################################
@@ -393,18 +587,33 @@ class des(_baseDes):
 	ENCRYPT =	0x00
 	DECRYPT =	0x01
 
+	# Integer lookup tables derived from the bit tables above. They are
+	# built once, on first use, by __init_tables().
+	#
+	# Blocks are handled as 64-bit integers where bit 0 of the DES tables
+	# is the most significant bit of the first byte.
+	__ip_bytes = None	# IP, indexed by [byte position][byte value]
+	__fp_bytes = None	# FP, indexed by [byte position][byte value]
+	__spbox = None		# S-box output followed by P, indexed by [box][6 bits]
+	__np_tables = None	# numpy uint64 copies of (ip_bytes, fp_bytes, spbox)
+
 	# Initialisation
 	def __init__(self, key, mode=ECB, IV=None, pad=None, padmode=PAD_NORMAL):
 		# Sanity checking of arguments.
 		if len(key) != 8:
 			raise ValueError("Invalid DES key size. Key must be exactly 8 bytes long.")
+		if des.__spbox is None:
+			des.__init_tables()
 		_baseDes.__init__(self, mode, IV, pad, padmode)
 		self.key_size = 8
 
-		self.L = []
-		self.R = []
-		self.Kn = [ [0] * 48 ] * 16	# 16 48-bit keys (K1 - K16)
-		self.final = []
+		# Key stages indexed by ENCRYPT/DECRYPT: ((K1 - K16),) and
+		# ((K16 - K1),). Each subkey is eight 6-bit values. Replaced as a
+		# whole by setKey(), so a crypt running in another thread always
+		# sees a consistent key schedule. triple_des chains the stages of
+		# its three keys to run all 48 rounds in one pass.
+		self._stages = ((), ())
+		self.__block_cache = None
 
 		self.setKey(key)
 
@@ -412,153 +621,238 @@ class des(_baseDes):
 		"""Will set the crypting key for this object. Must be 8 bytes."""
 		_baseDes.setKey(self, key)
 		self.__create_sub_keys()
+		if self.__block_cache is not None:
+			self.__block_cache = _BlockCache(self.__block_cache.size)
 
-	def __String_to_BitList(self, data):
-		"""Turn the string data, into a list of bits (1, 0)'s"""
-		if _pythonMajorVersion < 3:
-			# Turn the strings into integers. Python 3 uses a bytes
-			# class, which already has this behaviour.
-			data = [ord(c) for c in data]
-		l = len(data) * 8
-		result = [0] * l
-		pos = 0
-		for ch in data:
-			i = 7
-			while i >= 0:
-				if ch & (1 << i) != 0:
-					result[pos] = 1
-				else:
-					result[pos] = 0
-				pos += 1
-				i -= 1
+	def setBlockCache(self, size):
+		"""Cache up to size crypted blocks per direction in ECB mode. 0 disables.
 
+		Opt-in memoization for repetitive data: blocks seen before are not
+		crypted again. The cache belongs to the key and is cleared by
+		setKey(). Calling it again with the same size keeps the cache.
+		"""
+		if not size:
+			self.__block_cache = None
+		elif self.__block_cache is None or self.__block_cache.size != size:
+			self.__block_cache = _BlockCache(size)
+
+	def getBlockCacheStats(self):
+		"""getBlockCacheStats() -> dict with size, max_size, hits and misses or None"""
+		if self.__block_cache is None:
+			return None
+		return self.__block_cache.stats()
+
+	@staticmethod
+	def __permutate(table, value, width):
+		"""Permutate the width bits integer value with the specified table"""
+		result = 0
+		for src in table:
+			result = (result << 1) | ((value >> (width - 1 - src)) & 1)
 		return result
 
-	def __BitList_to_String(self, data):
-		"""Turn the list of bits -> data, into a string"""
-		result = []
-		pos = 0
-		c = 0
-		while pos < len(data):
-			c += data[pos] << (7 - (pos % 8))
-			if (pos % 8) == 7:
-				result.append(c)
-				c = 0
-			pos += 1
+	@staticmethod
+	def __byte_tables(table):
+		"""Split a 64 bit permutation table into 8 byte-indexed tables"""
+		out_width = len(table)
+		tables = [[0] * 256 for _ in range(8)]
+		for dst, src in enumerate(table):
+			mask = 0x80 >> (src & 7)
+			bit = 1 << (out_width - 1 - dst)
+			byte_table = tables[src >> 3]
+			for value in range(256):
+				if value & mask:
+					byte_table[value] |= bit
+		return [tuple(t) for t in tables]
+
+	@staticmethod
+	def __init_tables():
+		"""Build the integer lookup tables used by __des_crypt()"""
+		spbox = []
+		for j in range(8):
+			box = []
+			for v in range(64):
+				row = ((v >> 4) & 2) | (v & 1)
+				col = (v >> 1) & 0x0F
+				# S-box output is placed at bits 4j..4j+3 before P
+				s = des.__sbox[j][(row << 4) + col] << (28 - 4 * j)
+				box.append(des.__permutate(des.__p, s, 32))
+			spbox.append(tuple(box))
+
+		des.__ip_bytes = des.__byte_tables(des.__ip)
+		des.__fp_bytes = des.__byte_tables(des.__fp)
+		des.__spbox = tuple(spbox)
 
-		if _pythonMajorVersion < 3:
-			return ''.join([ chr(c) for c in result ])
-		else:
-			return bytes(result)
-
-	def __permutate(self, table, block):
-		"""Permutate this block with the specified table"""
-		return list(map(lambda x: block[x], table))
-	
 	# Transform the secret key, so that it is ready for data processing
 	# Create the 16 subkeys, K[1] - K[16]
 	def __create_sub_keys(self):
 		"""Create the 16 subkeys K[1] to K[16] from the given key"""
-		key = self.__permutate(des.__pc1, self.__String_to_BitList(self.getKey()))
-		i = 0
+		Kn, Kn_rev = key_schedule_cache.get(self.getKey(), des.__key_schedule)
+		self._stages = ((Kn,), (Kn_rev,))
+
+	@staticmethod
+	def __key_schedule(key):
+		"""key_schedule(key) -> (subkeys, reversed subkeys)"""
+		key = struct.unpack('>Q', key)[0]
+		key = des.__permutate(des.__pc1, key, 64)
+
 		# Split into Left and Right sections
-		self.L = key[:28]
-		self.R = key[28:]
-		while i < 16:
-			j = 0
+		L = key >> 28
+		R = key & 0x0FFFFFFF
+		Kn = []
+		for shift in des.__left_rotations:
 			# Perform circular left shifts
-			while j < des.__left_rotations[i]:
-				self.L.append(self.L[0])
-				del self.L[0]
+			L = ((L << shift) | (L >> (28 - shift))) & 0x0FFFFFFF
+			R = ((R << shift) | (R >> (28 - shift))) & 0x0FFFFFFF
 
-				self.R.append(self.R[0])
-				del self.R[0]
+			# Create one of the 16 subkeys through pc2 permutation and
+			# split it into the 6-bit groups feeding the S-boxes
+			k = des.__permutate(des.__pc2, (L << 28) | R, 56)
+			Kn.append(tuple((k >> (42 - 6 * j)) & 0x3F for j in range(8)))
 
-				j += 1
+		return tuple(Kn), tuple(Kn[::-1])
 
-			# Create one of the 16 subkeys through pc2 permutation
-			self.Kn[i] = self.__permutate(des.__pc2, self.L + self.R)
+	# Main part of the encryption algorithm, the number cruncher :)
+	@staticmethod
+	def __des_crypt(block, stages):
+		"""Crypt the 64 bit integer block through DES table lookups
 
-			i += 1
+		stages is a sequence of 16 subkey lists, in the order they are
+		applied. A single DES has one stage, triple DES three. The state
+		is kept in local variables only.
+		"""
+		ip0, ip1, ip2, ip3, ip4, ip5, ip6, ip7 = des.__ip_bytes
+		block = (ip0[block >> 56] | ip1[(block >> 48) & 0xFF] |
+			 ip2[(block >> 40) & 0xFF] | ip3[(block >> 32) & 0xFF] |
+			 ip4[(block >> 24) & 0xFF] | ip5[(block >> 16) & 0xFF] |
+			 ip6[(block >> 8) & 0xFF] | ip7[block & 0xFF])
+		L = block >> 32
+		R = block & 0xFFFFFFFF
+
+		sp0, sp1, sp2, sp3, sp4, sp5, sp6, sp7 = des.__spbox
+		for keys in stages:
+			for k0, k1, k2, k3, k4, k5, k6, k7 in keys:
+				# Expansion of R into 8 6-bit groups: bit 32 of R is rotated
+				# in front of bit 1 and bit 1 behind bit 32 (34 bits in total)
+				x = ((R & 1) << 33) | (R << 1) | (R >> 31)
+				f = (sp0[((x >> 28) & 0x3F) ^ k0] | sp1[((x >> 24) & 0x3F) ^ k1] |
+				     sp2[((x >> 20) & 0x3F) ^ k2] | sp3[((x >> 16) & 0x3F) ^ k3] |
+				     sp4[((x >> 12) & 0x3F) ^ k4] | sp5[((x >> 8) & 0x3F) ^ k5] |
+				     sp6[((x >> 4) & 0x3F) ^ k6] | sp7[(x & 0x3F) ^ k7])
+				L, R = R, L ^ f
+			# R[16]L[16] is the output of this stage. FP followed by the
+			# IP of the next stage cancel out, which leaves only the swap.
+			L, R = R, L
 
-	# Main part of the encryption algorithm, the number cruncher :)
-	def __des_crypt(self, block, crypt_type):
-		"""Crypt the block of data through DES bit-manipulation"""
-		block = self.__permutate(des.__ip, block)
-		self.L = block[:32]
-		self.R = block[32:]
-
-		# Encryption starts from Kn[1] through to Kn[16]
-		if crypt_type == des.ENCRYPT:
-			iteration = 0
-			iteration_adjustment = 1
-		# Decryption starts from Kn[16] down to Kn[1]
-		else:
-			iteration = 15
-			iteration_adjustment = -1
-
-		i = 0
-		while i < 16:
-			# Make a copy of R[i-1], this will later become L[i]
-			tempR = self.R[:]
-
-			# Permutate R[i - 1] to start creating R[i]
-			self.R = self.__permutate(des.__expansion_table, self.R)
-
-			# Exclusive or R[i - 1] with K[i], create B[1] to B[8] whilst here
-			self.R = list(map(lambda x, y: x ^ y, self.R, self.Kn[iteration]))
-			B = [self.R[:6], self.R[6:12], self.R[12:18], self.R[18:24], self.R[24:30], self.R[30:36], self.R[36:42], self.R[42:]]
-			# Optimization: Replaced below commented code with above
-			#j = 0
-			#B = []
-			#while j < len(self.R):
-			#	self.R[j] = self.R[j] ^ self.Kn[iteration][j]
-			#	j += 1
-			#	if j % 6 == 0:
-			#		B.append(self.R[j-6:j])
-
-			# Permutate B[1] to B[8] using the S-Boxes
-			j = 0
-			Bn = [0] * 32
-			pos = 0
-			while j < 8:
-				# Work out the offsets
-				m = (B[j][0] << 1) + B[j][5]
-				n = (B[j][1] << 3) + (B[j][2] << 2) + (B[j][3] << 1) + B[j][4]
-
-				# Find the permutation value
-				v = des.__sbox[j][(m << 4) + n]
-
-				# Turn value into bits, add it to result: Bn
-				Bn[pos] = (v & 8) >> 3
-				Bn[pos + 1] = (v & 4) >> 2
-				Bn[pos + 2] = (v & 2) >> 1
-				Bn[pos + 3] = v & 1
-
-				pos += 4
-				j += 1
-
-			# Permutate the concatination of B[1] to B[8] (Bn)
-			self.R = self.__permutate(des.__p, Bn)
-
-			# Xor with L[i - 1]
-			self.R = list(map(lambda x, y: x ^ y, self.R, self.L))
-			# Optimization: This now replaces the below commented code
-			#j = 0
-			#while j < len(self.R):
-			#	self.R[j] = self.R[j] ^ self.L[j]
-			#	j += 1
-
-			# L[i] becomes R[i - 1]
-			self.L = tempR
-
-			i += 1
-			iteration += iteration_adjustment
-		
 		# Final permutation of R[16]L[16]
-		self.final = self.__permutate(des.__fp, self.R + self.L)
-		return self.final
+		block = (L << 32) | R
+		fp0, fp1, fp2, fp3, fp4, fp5, fp6, fp7 = des.__fp_bytes
+		return (fp0[block >> 56] | fp1[(block >> 48) & 0xFF] |
+			fp2[(block >> 40) & 0xFF] | fp3[(block >> 32) & 0xFF] |
+			fp4[(block >> 24) & 0xFF] | fp5[(block >> 16) & 0xFF] |
+			fp6[(block >> 8) & 0xFF] | fp7[block & 0xFF])
+
+
+	@staticmethod
+	def __get_np_tables():
+		"""The integer lookup tables as numpy uint64 arrays"""
+		if des.__np_tables is None:
+			des.__np_tables = tuple(
+				_np.array(table, dtype=_np.uint64)
+				for table in (des.__ip_bytes, des.__fp_bytes, des.__spbox))
+		return des.__np_tables
+
+	@staticmethod
+	def _crypt_array(blocks, stages):
+		"""Crypt a numpy uint64 array of blocks, all blocks at once.
+
+		This is __des_crypt() applied element wise, every round is a few
+		array operations over the whole batch.
+		"""
+		ip, fp, spbox = des.__get_np_tables()
+		sp0, sp1, sp2, sp3, sp4, sp5, sp6, sp7 = spbox
+		mask = _np.uint64(0xFF)
+
+		block = ip[0][blocks >> _np.uint64(56)]
+		for i in range(1, 8):
+			block |= ip[i][(blocks >> _np.uint64(56 - 8 * i)) & mask]
+		L = block >> _np.uint64(32)
+		R = block & _np.uint64(0xFFFFFFFF)
+
+		one, six = _np.uint64(1), _np.uint64(0x3F)
+		s4, s8, s12, s16 = _np.uint64(4), _np.uint64(8), _np.uint64(12), _np.uint64(16)
+		s20, s24, s28, s31, s33 = _np.uint64(20), _np.uint64(24), _np.uint64(28), _np.uint64(31), _np.uint64(33)
+		for keys in stages:
+			for k0, k1, k2, k3, k4, k5, k6, k7 in keys:
+				x = ((R & one) << s33) | (R << one) | (R >> s31)
+				f = sp0[((x >> s28) & six) ^ _np.uint64(k0)]
+				f |= sp1[((x >> s24) & six) ^ _np.uint64(k1)]
+				f |= sp2[((x >> s20) & six) ^ _np.uint64(k2)]
+				f |= sp3[((x >> s16) & six) ^ _np.uint64(k3)]
+				f |= sp4[((x >> s12) & six) ^ _np.uint64(k4)]
+				f |= sp5[((x >> s8) & six) ^ _np.uint64(k5)]
+				f |= sp6[((x >> s4) & six) ^ _np.uint64(k6)]
+				f |= sp7[(x & six) ^ _np.uint64(k7)]
+				f ^= L
+				L, R = R, f
+			L, R = R, L
+
+		block = (L << _np.uint64(32)) | R
+		result = fp[0][block >> _np.uint64(56)]
+		for i in range(1, 8):
+			result |= fp[i][(block >> _np.uint64(56 - 8 * i)) & mask]
+		return result
+
+	@staticmethod
+	def _crypt_blocks(data, stages, crypt_type, iv, cache=None):
+		"""Crypt data, a multiple of 8 bytes, into a list of 64 bit integers.
+
+		stages are the key stages to run, see __des_crypt(). iv is the
+		integer IV for CBC mode or None for ECB. cache is an optional
+		_BlockCache used in ECB mode. Returns the result list and the IV
+		to continue the CBC chain with.
+		"""
+		des_crypt = des.__des_crypt
+
+		# Split the data into 64 bit blocks, crypting each one seperately
+		blocks = struct.unpack('>%dQ' % (len(data) // 8), data)
 
+		if iv is None:
+			if cache is None:
+				return [des_crypt(block, stages) for block in blocks], None
+
+			table = cache.blocks[crypt_type]
+			result = []
+			misses = 0
+			for block in blocks:
+				crypted = table.get(block)
+				if crypted is None:
+					crypted = des_crypt(block, stages)
+					cache.add(table, block, crypted)
+					misses += 1
+				result.append(crypted)
+			cache.count(len(blocks) - misses, misses)
+			return result, None
+
+		result = []
+		for block in blocks:
+			# Xor with IV if using CBC mode
+			if crypt_type == des.ENCRYPT:
+				iv = des_crypt(block ^ iv, stages)
+				result.append(iv)
+			else:
+				result.append(des_crypt(block, stages) ^ iv)
+				iv = block
+		return result, iv
+
+	def __get_int_iv(self, iv=None):
+		# The CBC IV as integer, None in ECB mode
+		if self.getMode() != CBC:
+			return None
+		if iv is None:
+			iv = self.getIV()
+		if not iv:
+			raise ValueError("For CBC mode, you must supply the Initial Value (IV) for ciphering")
+		return struct.unpack('>Q', iv)[0]
 
 	# Data to be encrypted/decrypted
 	def crypt(self, data, crypt_type):
@@ -576,68 +870,38 @@ class des(_baseDes):
 				data += (self.block_size - (len(data) % self.block_size)) * self.getPadding()
 			# print "Len of data: %f" % (len(data) / self.block_size)
 
-		if self.getMode() == CBC:
-			if self.getIV():
-				iv = self.__String_to_BitList(self.getIV())
-			else:
-				raise ValueError("For CBC mode, you must supply the Initial Value (IV) for ciphering")
+		result, _ = des._crypt_blocks(data, self._stages[crypt_type], crypt_type,
+					      self.__get_int_iv(), self.__block_cache)
 
-		# Split the data into blocks, crypting each one seperately
-		i = 0
-		dict = {}
-		result = []
-		#cached = 0
-		#lines = 0
-		while i < len(data):
-			# Test code for caching encryption results
-			#lines += 1
-			#if dict.has_key(data[i:i+8]):
-				#print "Cached result for: %s" % data[i:i+8]
-			#	cached += 1
-			#	result.append(dict[data[i:i+8]])
-			#	i += 8
-			#	continue
-				
-			block = self.__String_to_BitList(data[i:i+8])
+		# Return the full crypted string
+		return struct.pack('>%dQ' % len(result), *result)
 
-			# Xor with IV if using CBC mode
-			if self.getMode() == CBC:
-				if crypt_type == des.ENCRYPT:
-					block = list(map(lambda x, y: x ^ y, block, iv))
-					#j = 0
-					#while j < len(block):
-					#	block[j] = block[j] ^ iv[j]
-					#	j += 1
-
-				processed_block = self.__des_crypt(block, crypt_type)
-
-				if crypt_type == des.DECRYPT:
-					processed_block = list(map(lambda x, y: x ^ y, processed_block, iv))
-					#j = 0
-					#while j < len(processed_block):
-					#	processed_block[j] = processed_block[j] ^ iv[j]
-					#	j += 1
-					iv = block
-				else:
-					iv = processed_block
-			else:
-				processed_block = self.__des_crypt(block, crypt_type)
+	def crypt_into(self, data, out, crypt_type, iv=None):
+		"""crypt_into(data, out, crypt_type, [iv]) -> bytes or None
 
+		data : bytes, bytearray or memoryview, a multiple of 8 bytes
+		out  : Writable buffer (bytearray, memoryview) of at least len(data)
+		       bytes, receives the crypted data
+		crypt_type : des.ENCRYPT or des.DECRYPT
+		iv   : Optional IV used instead of the instance IV in CBC mode
 
-			# Add the resulting crypted block to our list
-			#d = self.__BitList_to_String(processed_block)
-			#result.append(d)
-			result.append(self.__BitList_to_String(processed_block))
-			#dict[data[i:i+8]] = d
-			i += 8
+		Crypt data into a caller supplied buffer. No padding is done and
+		the instance is never modified, so one object can crypt from many
+		threads at the same time. In CBC mode the returned bytes are the
+		IV that continues the chain on the next call, None in ECB mode.
+		"""
+		if len(data) % self.block_size != 0:
+			raise ValueError("Invalid data length, data must be a multiple of " + str(self.block_size) + " bytes\n.")
+		if len(out) < len(data):
+			raise ValueError("Output buffer is smaller than data")
 
-		# print "Lines: %d, cached: %d" % (lines, cached)
+		result, iv = des._crypt_blocks(data, self._stages[crypt_type], crypt_type,
+					       self.__get_int_iv(iv), self.__block_cache)
+		struct.pack_into('>%dQ' % len(result), out, 0, *result)
 
-		# Return the full crypted string
-		if _pythonMajorVersion < 3:
-			return ''.join(result)
-		else:
-			return bytes.fromhex('').join(result)
+		if iv is None:
+			return None
+		return struct.pack('>Q', iv)
 
 	def encrypt(self, data, pad=None, padmode=None):
 		"""encrypt(data, [pad], [padmode]) -> bytes
@@ -732,6 +996,17 @@ class triple_des(_baseDes):
 		else:
 			self.__key3 = des(key[16:], self._mode, self._iv,
 					  self._padding, self._padmode)
+
+		# Encryption is E(K1), D(K2), E(K3) and decryption the reverse.
+		# The stages of the three keys are chained, so a block stays in
+		# its integer form through all 48 rounds.
+		ENCRYPT = des.ENCRYPT
+		DECRYPT = des.DECRYPT
+		self._stages = (
+			self.__key1._stages[ENCRYPT] + self.__key2._stages[DECRYPT] +
+			self.__key3._stages[ENCRYPT],
+			self.__key3._stages[DECRYPT] + self.__key2._stages[ENCRYPT] +
+			self.__key1._stages[DECRYPT])
 		_baseDes.setKey(self, key)
 
 	# Override setter methods to work on all 3 keys.
@@ -760,6 +1035,30 @@ class triple_des(_baseDes):
 		for key in (self.__key1, self.__key2, self.__key3):
 			key.setIV(IV)
 
+	def crypt_into(self, data, out, crypt_type, iv=None):
+		"""crypt_into(data, out, crypt_type, [iv]) -> bytes or None
+
+		Triple DES version of des.crypt_into(), see there.
+		"""
+		if len(data) % self.block_size != 0:
+			raise ValueError("Invalid data length, data must be a multiple of " + str(self.block_size) + " bytes\n.")
+		if len(out) < len(data):
+			raise ValueError("Output buffer is smaller than data")
+
+		if self.getMode() == CBC:
+			if iv is None:
+				iv = self.getIV()
+			iv = struct.unpack('>Q', iv)[0]
+		else:
+			iv = None
+
+		result, iv = des._crypt_blocks(data, self._stages[crypt_type], crypt_type, iv)
+		struct.pack_into('>%dQ' % len(result), out, 0, *result)
+
+		if iv is None:
+			return None
+		return struct.pack('>Q', iv)
+
 	def encrypt(self, data, pad=None, padmode=None):
 		"""encrypt(data, [pad], [padmode]) -> bytes
 
@@ -774,35 +1073,16 @@ class triple_des(_baseDes):
 		ensure the be padded data is a multiple of 8 bytes.
 		"""
 		ENCRYPT = des.ENCRYPT
-		DECRYPT = des.DECRYPT
 		data = self._guardAgainstUnicode(data)
 		if pad is not None:
 			pad = self._guardAgainstUnicode(pad)
 		# Pad the data accordingly.
 		data = self._padData(data, pad, padmode)
+		iv = None
 		if self.getMode() == CBC:
-			self.__key1.setIV(self.getIV())
-			self.__key2.setIV(self.getIV())
-			self.__key3.setIV(self.getIV())
-			i = 0
-			result = []
-			while i < len(data):
-				block = self.__key1.crypt(data[i:i+8], ENCRYPT)
-				block = self.__key2.crypt(block, DECRYPT)
-				block = self.__key3.crypt(block, ENCRYPT)
-				self.__key1.setIV(block)
-				self.__key2.setIV(block)
-				self.__key3.setIV(block)
-				result.append(block)
-				i += 8
-			if _pythonMajorVersion < 3:
-				return ''.join(result)
-			else:
-				return bytes.fromhex('').join(result)
-		else:
-			data = self.__key1.crypt(data, ENCRYPT)
-			data = self.__key2.crypt(data, DECRYPT)
-			return self.__key3.crypt(data, ENCRYPT)
+			iv = struct.unpack('>Q', self.getIV())[0]
+		result, _ = des._crypt_blocks(data, self._stages[ENCRYPT], ENCRYPT, iv)
+		return struct.pack('>%dQ' % len(result), *result)
 
 	def decrypt(self, data, pad=None, padmode=None):
 		"""decrypt(data, [pad], [padmode]) -> bytes
@@ -820,33 +1100,148 @@ class triple_des(_baseDes):
 		padding end markers will be removed from the data after
 		decrypting, no pad character is required for PAD_PKCS5.
 		"""
-		ENCRYPT = des.ENCRYPT
 		DECRYPT = des.DECRYPT
 		data = self._guardAgainstUnicode(data)
 		if pad is not None:
 			pad = self._guardAgainstUnicode(pad)
+		if len(data) % self.block_size != 0:
+			raise ValueError("Invalid data length, data must be a multiple of " + str(self.block_size) + " bytes\n.")
+		iv = None
 		if self.getMode() == CBC:
-			self.__key1.setIV(self.getIV())
-			self.__key2.setIV(self.getIV())
-			self.__key3.setIV(self.getIV())
-			i = 0
-			result = []
-			while i < len(data):
-				iv = data[i:i+8]
-				block = self.__key3.crypt(iv,    DECRYPT)
-				block = self.__key2.crypt(block, ENCRYPT)
-				block = self.__key1.crypt(block, DECRYPT)
-				self.__key1.setIV(iv)
-				self.__key2.setIV(iv)
-				self.__key3.setIV(iv)
-				result.append(block)
-				i += 8
-			if _pythonMajorVersion < 3:
-				data = ''.join(result)
+			iv = struct.unpack('>Q', self.getIV())[0]
+		result, _ = des._crypt_blocks(data, self._stages[DECRYPT], DECRYPT, iv)
+		data = struct.pack('>%dQ' % len(result), *result)
+		return self._unpadData(data, pad, padmode)
+
+
+
+#############################################################################
+# 				Streaming				    #
+#############################################################################
+class crypt_stream(object):
+	"""Incremental encryption/decryption context
+
+	Created by des.encryptor()/decryptor() (or the triple_des ones).
+
+	update(data, [out]) -> bytes or number of bytes written
+	finalize([out])     -> bytes or number of bytes written
+
+	data -> bytes, bytearray or memoryview chunk of any length
+	out  -> Optional writable buffer receiving the result. update() needs
+		room for len(data) + 8 bytes and finalize() for 8 bytes. When
+		out is given the number of bytes written is returned, otherwise
+		the result is returned as bytes.
+
+	Whole blocks are crypted straight from the input chunk into the
+	output, only a partial block (and on decryption the last block, for
+	unpadding) is kept between calls. Padding is handled by finalize().
+	"""
+	def __init__(self, cipher, crypt_type, pad=None, padmode=None):
+		if pad is not None:
+			pad = cipher._guardAgainstUnicode(pad)
+		if padmode is None:
+			padmode = cipher.getPadMode()
+		if pad and padmode == PAD_PKCS5:
+			raise ValueError("Cannot use a pad character with PAD_PKCS5")
+		if not pad:
+			pad = cipher.getPadding()
+
+		self._cipher = cipher
+		self._crypt_type = crypt_type
+		self._pad = pad
+		self._padmode = padmode
+		self._block_size = cipher.block_size
+		self._iv = cipher.getIV() if cipher.getMode() == CBC else None
+		self._pending = bytearray(self._block_size)
+		self._pending_len = 0
+		self._finalized = False
+
+	def _crypt(self, data, out, pos):
+		# Crypt whole blocks of data into out at pos, keeping the CBC chain
+		if len(data):
+			iv = self._cipher.crypt_into(data, memoryview(out)[pos:], self._crypt_type, self._iv)
+			if iv is not None:
+				self._iv = iv
+		return pos + len(data)
+
+	def update(self, data, out=None):
+		if self._finalized:
+			raise ValueError("update() called after finalize()")
+		data = memoryview(self._cipher._guardAgainstUnicode(data))
+		if data.itemsize != 1:
+			data = data.cast('B')
+
+		result = None
+		if out is None:
+			result = out = bytearray(len(data) + self._block_size)
+		out = memoryview(out)
+		block_size = self._block_size
+		decrypting = self._crypt_type == des.DECRYPT
+		pos = 0
+
+		# Complete the pending partial block first
+		if self._pending_len:
+			take = min(block_size - self._pending_len, len(data))
+			self._pending[self._pending_len:self._pending_len + take] = data[:take]
+			self._pending_len += take
+			data = data[take:]
+			if self._pending_len == block_size and (len(data) or not decrypting):
+				pos = self._crypt(self._pending, out, pos)
+				self._pending_len = 0
+
+		# Crypt all whole blocks in place. On decryption the last block is
+		# held back until finalize() as it carries the padding.
+		whole = len(data) - len(data) % block_size
+		if decrypting and whole and whole == len(data):
+			whole -= block_size
+		pos = self._crypt(data[:whole], out, pos)
+
+		rest = data[whole:]
+		if len(rest):
+			self._pending[:len(rest)] = rest
+			self._pending_len = len(rest)
+
+		if result is not None:
+			return bytes(result[:pos])
+		return pos
+
+	def finalize(self, out=None):
+		if self._finalized:
+			raise ValueError("finalize() called twice")
+		self._finalized = True
+
+		block_size = self._block_size
+		pending_len = self._pending_len
+		block = self._pending
+		self._pending_len = 0
+
+		if self._crypt_type == des.ENCRYPT:
+			if self._padmode == PAD_PKCS5:
+				pad_len = block_size - pending_len
+				block[pending_len:] = bytearray([pad_len]) * pad_len
+			elif pending_len:
+				if not self._pad:
+					raise ValueError("Data must be a multiple of " + str(block_size) + " bytes in length. Use padmode=PAD_PKCS5 or set the pad character.")
+				block[pending_len:] = self._pad * (block_size - pending_len)
+			else:
+				block = None
+			result = bytearray(block_size)
+			if block is not None:
+				self._crypt(block, result, 0)
 			else:
-				data = bytes.fromhex('').join(result)
+				result = result[:0]
 		else:
-			data = self.__key3.crypt(data, DECRYPT)
-			data = self.__key2.crypt(data, ENCRYPT)
-			data = self.__key1.crypt(data, DECRYPT)
-		return self._unpadData(data, pad, padmode)
+			if pending_len not in (0, block_size):
+				raise ValueError("Invalid data length, data must be a multiple of " + str(block_size) + " bytes\n.")
+			result = bytearray(block_size)
+			if pending_len:
+				self._crypt(block, result, 0)
+				result = self._cipher._unpadData(bytes(result), self._pad, self._padmode)
+			else:
+				result = result[:0]
+
+		if out is None:
+			return bytes(result)
+		out[:len(result)] = result
+		return len(result)
+
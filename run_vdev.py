@@ -5,6 +5,8 @@ import argparse
 import sys
 import logging
 import json
+import signal
+import threading
 
 logger = logging.getLogger("root")
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
@@ -57,6 +59,63 @@ def setup_command_args():
 
     parser.add_argument('-loop', help='Loop two multiple vdev through MQTT. Looped device acts as a platform', action='store_true')
 
+    parser.add_argument('-fleet', metavar='fleet_file', dest='fleet', type=str,
+        help='Simulate all devices listed in fleet JSON file over one MQTT connection (subscribe mode only)')
+
+    parser.add_argument('-fleetconns', metavar='N', dest='fleet_conns', type=int, default=1,
+        help='Number of MQTT connections used in fleet mode. Default=1')
+
+    parser.add_argument('-txcache', metavar='size', dest='tx_cache', type=int, default=0,
+        help='Cache up to size encoded outbound messages. Repeated states are sent without encoding again. Default=0 (disabled)')
+
+    parser.add_argument('-cryptoworkers', metavar='N', dest='crypto_workers', type=int, default=0,
+        help='Encrypt/decrypt messages in N worker processes. Default=0 (in the MQTT thread)')
+
+    parser.add_argument('-blockcache', metavar='size', dest='block_cache', type=int, default=0,
+        help='Cache up to size encrypted 8 byte blocks per key. Speeds up repetitive encrypted traffic. Default=0 (disabled)')
+
+    parser.add_argument('-coalesce', metavar='msec', dest='coalesce', type=int,
+        help='txmodule only. Merge data generated within msec into one message (last value of a field wins)')
+
+    parser.add_argument('-coalescemax', metavar='bytes', dest='coalesce_max', type=int, default=4096,
+        help='Max JSON size of a coalesced message. Default=4096')
+
+    parser.add_argument('-readwindow', metavar='msec', dest='read_window', type=int, default=0,
+        help='Subscribe mode. Answer read-requests received within msec with one response. Default=0 (disabled)')
+
+    parser.add_argument('-delta', action='store_true',
+        help='Publish only fields changed since the last acknowledged publish (gui and full state responses)')
+
+    parser.add_argument('-fullrefresh', metavar='sec', dest='full_refresh', type=float, default=0,
+        help='With -delta, publish the full state every sec seconds. Default=0 (disabled)')
+
+    parser.add_argument('-streamdecode', dest='stream_decode', choices=['apply', 'atomic'],
+        help='Parse, validate and apply "data" entries of platform messages one by one. '
+        'atomic: apply the writes only if all entries are valid')
+
+    parser.add_argument('-maxinflight', metavar='N', dest='max_inflight', type=int, default=0,
+        help='txmodule only. Max published messages not yet acknowledged. Default=0 (unlimited)')
+
+    parser.add_argument('-txqueue', metavar='size', dest='tx_queue', type=int, default=0,
+        help='txmodule only. Max generated items waiting for publish. Default=0 (unlimited)')
+
+    parser.add_argument('-txpolicy', dest='tx_policy', default='block',
+        choices=['block', 'drop-oldest', 'drop-newest', 'coalesce'],
+        help='What to do with generated items when the -txqueue is full. Default=block')
+
+    parser.add_argument('-shmstate', metavar='name', dest='shm_state', type=str,
+        help='Export device state to shared memory "name". Read with: python shmstate.py name')
+
+    parser.add_argument('-async', dest='use_async', action='store_true',
+        help='Run devices and txmodule streams on one asyncio event loop instead of threads (subscribe, txmodule and fleet mode)')
+
+    parser.add_argument('-qos', dest='qos', type=int, choices=[0, 1, 2], default=0,
+        help='QoS of messages published to the platform. Default=0')
+
+    parser.add_argument('-latency', metavar='file', dest='latency', nargs='?', const='',
+        help='Track publish latency (publish to acknowledgement) per device and QoS. Logged on exit and on SIGUSR1, '
+        'with file also written there as JSON lines')
+
     args = parser.parse_args()
 
     if (args.param_value or args.tx_script) and args.gui:
@@ -65,24 +124,103 @@ def setup_command_args():
     if args.param_value and args.tx_script:
         parser.error('-txmodule is not supported with param=value!')
 
+    if args.fleet and (args.param_value or args.gui or args.device_id or args.enc_key):
+        parser.error('-fleet only supports subscribe mode, device-id and key are set in fleet file!')
+
+    if args.fleet and args.tx_script and not args.use_async:
+        parser.error('-txmodule with -fleet is only supported with -async!')
+
+    if args.coalesce is not None and (not args.tx_script or args.fleet or args.use_async):
+        parser.error('-coalesce is only supported with -txmodule for a single device!')
+
+    if (args.max_inflight or args.tx_queue) and (not args.tx_script or args.fleet or args.use_async):
+        parser.error('-maxinflight and -txqueue are only supported with -txmodule for a single device!')
+
+    if args.use_async and (args.param_value or args.gui):
+        parser.error('-async is not supported with param=value or -gui!')
+
     return parser.parse_args()
 
 def show_press_ctrlc():
     print("Press CTRL+C to quit")
 
-def wait_for_tx_done(dev, tx_script):
+def log_device_stats(dev):
+    stats = dev.get_tx_cache_stats()
+    if stats:
+        logger.info('Tx cache: {}'.format(stats))
+    stats = dev.get_read_coalescing_stats()
+    if stats:
+        logger.info('Read coalescing: {}'.format(stats))
+    stats = dev.get_delta_stats()
+    if stats:
+        logger.info('Delta publishing: {}'.format(stats))
+    stats = dev.get_policy_stats()
+    if stats:
+        logger.info('Publish policy: {}'.format(stats))
+    stats = dev.get_publish_window_stats()
+    if stats:
+        logger.info('Publish window: {}'.format(stats))
+    stats = dev.get_latency_stats()
+    if stats:
+        logger.info('Publish latency: {}'.format(stats))
+
+def dump_latency(get_stats, dump, latency_file):
+    logger.info('Publish latency: {}'.format(get_stats()))
+    if latency_file:
+        with open(latency_file, 'w') as f:
+            dump(f)
+
+def install_latency_dump(get_stats, dump, latency_file, loop=None):
+    # Dump on demand with: kill -USR1 <pid>. The main thread may hold the
+    # PublishLatency lock when the signal arrives, so the dump runs in its
+    # own thread, or as a callback of the asyncio loop.
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    if loop:
+        loop.add_signal_handler(signal.SIGUSR1, dump_latency, get_stats, dump, latency_file)
+        return
+
+    def on_signal(signum, frame):
+        threading.Thread(target=dump_latency, args=(get_stats, dump, latency_file),
+            name='latency-dump', daemon=True).start()
+    signal.signal(signal.SIGUSR1, on_signal)
+
+def export_shm_state(dev, name):
+    import devstate
+    import shmstate
+
+    # All devices of a type share one state table
+    table = devstate.get_table(dev.device_schema)
+    try:
+        export = shmstate.SharedStateExport(table, name)
+    except FileExistsError as e:
+        logger.error(e)
+        sys.exit(1)
+    logger.info('Device state exported to shared memory "{}" ({} rows)'.format(export.name, export.capacity))
+    return export
+
+def wait_for_tx_done(dev, tx_script, coalescer=None, data_queue=None):
 
     if tx_script:
         from trafficgen import TrafficGen
 
-        tgen = TrafficGen(tx_script, dev.device_type_dic)
+        tgen = TrafficGen(tx_script, dev.device_schema.new_type_dict(), data_queue)
         tgen.start()
 
         show_press_ctrlc()
         try:
-            dev.send_to_platform_from_queue(tgen.get_queue())
+            if coalescer:
+                coalescer.run(tgen.get_queue())
+            else:
+                dev.send_to_platform_from_queue(tgen.get_queue())
         except KeyboardInterrupt:
             tgen.end()
+            log_device_stats(dev)
+            if coalescer:
+                logger.info('Coalescing: {}'.format(coalescer.get_stats()))
+            if data_queue:
+                logger.info('Tx queue: {}'.format(data_queue.get_stats()))
+            dev.stop()
             logger.info('Done!')
 
 
@@ -97,6 +235,8 @@ def wait_for_tx_done(dev, tx_script):
 
         time.sleep(0.3)
         dev.client.disconnect()
+        log_device_stats(dev)
+        dev.stop()
 
 def wait_for_subscribe_mode(dev, gui):
 
@@ -125,11 +265,132 @@ def wait_for_subscribe_mode(dev, gui):
             while not dev.is_stopped():
                 time.sleep(1)            
         except KeyboardInterrupt:
+            log_device_stats(dev)
+            dev.stop()
             logger.info('Done!')
         
 
 
 
+def run_fleet(args):
+    from vfleet import VdevFleet
+
+    fleet = VdevFleet(args.platform, args.device, args.fleet,
+        loop = args.loop,
+        crypto_workers = args.crypto_workers,
+        connections = args.fleet_conns,
+        track_latency = args.latency is not None,
+        publish_qos = args.qos,
+        enc_block_cache = args.block_cache,
+        tx_cache_size = args.tx_cache,
+        read_window = args.read_window / 1000.0,
+        delta = args.delta,
+        full_refresh = args.full_refresh,
+        stream_decode = bool(args.stream_decode),
+        stream_atomic = args.stream_decode == 'atomic'
+    )
+
+    if not fleet.devices:
+        return
+
+    export = None
+    if args.shm_state:
+        export = export_shm_state(next(iter(fleet.devices.values())), args.shm_state)
+
+    fleet.connect()
+
+    if fleet.track_latency:
+        install_latency_dump(fleet.get_latency_stats, fleet.dump_latency, args.latency)
+
+    show_press_ctrlc()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for stats in fleet.get_connection_stats():
+            logger.info('Connection stats: {}'.format(stats))
+        if fleet.track_latency:
+            dump_latency(fleet.get_latency_stats, fleet.dump_latency, args.latency)
+        fleet.disconnect()
+        fleet.stop()
+        logger.info('Done!')
+    finally:
+        if export:
+            export.close()
+
+def run_async(args):
+    import asyncio
+    from avdev import AsyncVdevRuntime
+
+    vdev_args = dict(
+        enable_subscribe = not args.tx_script,
+        loop = args.loop,
+        publish_qos = args.qos,
+        enc_block_cache = args.block_cache,
+        tx_cache_size = args.tx_cache,
+        read_window = args.read_window / 1000.0,
+        delta = args.delta,
+        full_refresh = args.full_refresh,
+        stream_decode = bool(args.stream_decode),
+        stream_atomic = args.stream_decode == 'atomic'
+    )
+
+    crypto = None
+    if args.crypto_workers:
+        import cryptopool
+        crypto = cryptopool.CryptoOffload(args.crypto_workers)
+
+    if args.fleet:
+        from vfleet import load_fleet_identities
+        identities = load_fleet_identities(args.fleet)
+    else:
+        identities = [(args.device_id, args.enc_key)]
+
+    devices = []
+    for device_id, enc_key in identities:
+        dev = Vdev(args.platform, args.device,
+            device_id = device_id, enc_key = enc_key, **vdev_args)
+        if dev.is_stopped():
+            continue
+        if crypto:
+            dev.set_crypto_offload(crypto)
+        devices.append(dev)
+
+    if devices:
+        with open(args.platform, 'r') as f:
+            plat_dic = json.load(f)
+
+        runtime = AsyncVdevRuntime(devices, plat_dic, args.tx_script,
+            track_latency = args.latency is not None)
+
+        async def run_runtime():
+            if runtime.latency:
+                install_latency_dump(runtime.latency.get_stats, runtime.latency.dump, args.latency,
+                    asyncio.get_running_loop())
+            await runtime.run()
+
+        export = None
+        if args.shm_state:
+            export = export_shm_state(devices[0], args.shm_state)
+
+        show_press_ctrlc()
+        try:
+            asyncio.run(run_runtime())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if export:
+                export.close()
+
+        for dev in devices:
+            log_device_stats(dev)
+        if runtime.latency:
+            dump_latency(runtime.latency.get_stats, runtime.latency.dump, args.latency)
+
+    if crypto:
+        crypto.shutdown()
+    logger.info('Done!')
+
 def run_vdev(args):
     # TX Mode is when there is a parameter for sending to the platform
     tx_mode = args.param_value or args.tx_script
@@ -151,24 +412,62 @@ def run_vdev(args):
         device_id = args.device_id,
         enc_key = args.enc_key,
         on_connect_tx_message = data_to_send,
-        loop = args.loop
+        loop = args.loop,
+        enc_block_cache = args.block_cache,
+        tx_cache_size = args.tx_cache,
+        read_window = args.read_window / 1000.0,
+        delta = args.delta,
+        full_refresh = args.full_refresh,
+        stream_decode = bool(args.stream_decode),
+        stream_atomic = args.stream_decode == 'atomic',
+        max_inflight = args.max_inflight,
+        publish_qos = args.qos,
+        track_latency = args.latency is not None,
+        crypto_workers = args.crypto_workers
     )
 
     if dev.is_stopped():
         return 
 
+    export = None
+    if args.shm_state:
+        export = export_shm_state(dev, args.shm_state)
 
     dev.connect()
 
-
-    if tx_mode:
-        wait_for_tx_done(dev, args.tx_script)
-    else:
-        wait_for_subscribe_mode(dev, args.gui)
+    if dev.latency:
+        install_latency_dump(dev.get_latency_stats, dev.latency.dump, args.latency)
+
+    try:
+        if tx_mode:
+            coalescer = None
+            if args.coalesce is not None:
+                from coalesce import CoalescingPublisher
+                coalescer = CoalescingPublisher(dev, args.coalesce / 1000.0, args.coalesce_max)
+
+            data_queue = None
+            if args.tx_queue:
+                from pipeline import BoundedDataQueue
+                data_queue = BoundedDataQueue(args.tx_queue, args.tx_policy)
+
+            wait_for_tx_done(dev, args.tx_script, coalescer, data_queue)
+        else:
+            wait_for_subscribe_mode(dev, args.gui)
+    finally:
+        if export:
+            export.close()
+        if dev.latency and args.latency:
+            with open(args.latency, 'w') as f:
+                dev.latency.dump(f)
  
     
 
 if __name__ == '__main__':
 
     args = setup_command_args()
-    run_vdev(args)    
+    if args.use_async:
+        run_async(args)
+    elif args.fleet:
+        run_fleet(args)
+    else:
+        run_vdev(args)    
@@ -0,0 +1,304 @@
+#! /usr/bin/python3
+# Device state table in shared memory, for monitor/assertion processes.
+#
+# The writer (SharedStateExport) mirrors a devstate.StateTable; readers
+# (SharedStateReader) attach by name and read rows without locks or IPC:
+# every row has a sequence counter that is odd while the row is written
+# (seqlock), a reader retries until it reads the same even value before
+# and after copying the row.
+#
+# Layout (little-endian):
+#   header   magic "VDST", version u16, reserved u16, capacity u32,
+#            row_size u32, rows_offset u32, meta_len u32, meta JSON
+#   row      seq u32, device-id (id_size bytes, NUL padded), fields
+#   fields   Boolean  u8   0/1, 2 = other value
+#            Number   u8 tag (0 other, 1 int, 2 float) + f64
+#            Enum     u16  item index, 0xffff = other value
+#            String   u16 length (0xffff = other value) + string_size bytes utf-8
+# "Other" values (e.g. a bool in a Number field) are read as None. Strings
+# and device-ids longer than string_size/id_size bytes are truncated on a
+# character boundary.
+#
+#   python shmstate.py name           (print the table)
+#   python shmstate.py -unlink name   (remove a stale block)
+#
+import json
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+
+MAGIC = b'VDST'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHHIIII')
+_SEQ = struct.Struct('<I')
+
+_BOOL = struct.Struct('<B')
+_NUMBER = struct.Struct('<Bd')
+_ENUM = struct.Struct('<H')
+_STR_LEN = struct.Struct('<H')
+
+OTHER_BOOL = 2
+OTHER_ENUM = 0xffff
+OTHER_STR = 0xffff
+NUMBER_OTHER, NUMBER_INT, NUMBER_FLOAT = 0, 1, 2
+
+# Blocks created by this process
+_exported = set()
+
+
+def _field_layout(schema, id_size, string_size):
+    fields = []
+    offset = _SEQ.size + id_size
+    for name in schema.names:
+        type_def = schema.type_dic[name]
+        type_str = type_def['type']
+        field = {'name':name, 'type':type_str, 'offset':offset}
+        if type_str == 'Boolean':
+            offset += _BOOL.size
+        elif type_str == 'Number':
+            offset += _NUMBER.size
+        elif type_str == 'Enum':
+            field['items'] = list(type_def['items'])
+            offset += _ENUM.size
+        else:
+            field['type'] = 'String'
+            offset += _STR_LEN.size + string_size
+        fields.append(field)
+
+    # Keep rows 8 byte aligned
+    row_size = (offset + 7) & ~7
+    return fields, row_size
+
+
+def _utf8(text, size):
+    # text as utf-8, truncated to at most size bytes on a character boundary
+    data = text.encode('utf-8')
+    if len(data) <= size:
+        return data
+    return data[:size].decode('utf-8', 'ignore').encode('utf-8')
+
+
+def _encode(field, value, string_size):
+    type_str = field['type']
+    if type_str == 'Boolean':
+        return _BOOL.pack(int(value) if value.__class__ is bool else OTHER_BOOL)
+
+    if type_str == 'Number':
+        cls = value.__class__
+        if cls is int:
+            try:
+                return _NUMBER.pack(NUMBER_INT, value)
+            except OverflowError:
+                return _NUMBER.pack(NUMBER_OTHER, 0.0)
+        if cls is float:
+            return _NUMBER.pack(NUMBER_FLOAT, value)
+        return _NUMBER.pack(NUMBER_OTHER, 0.0)
+
+    if type_str == 'Enum':
+        code = field['codes'].get(value) if value.__class__ is str else None
+        return _ENUM.pack(OTHER_ENUM if code is None else code)
+
+    if value.__class__ is not str:
+        return _STR_LEN.pack(OTHER_STR)
+    data = _utf8(value, string_size)
+    return _STR_LEN.pack(len(data)) + data
+
+
+def _decode(field, buf, string_size):
+    type_str, offset = field['type'], field['offset']
+    if type_str == 'Boolean':
+        value = _BOOL.unpack_from(buf, offset)[0]
+        return None if value == OTHER_BOOL else bool(value)
+
+    if type_str == 'Number':
+        tag, value = _NUMBER.unpack_from(buf, offset)
+        if tag == NUMBER_INT:
+            return int(value)
+        return value if tag == NUMBER_FLOAT else None
+
+    if type_str == 'Enum':
+        code = _ENUM.unpack_from(buf, offset)[0]
+        return None if code == OTHER_ENUM else field['items'][code]
+
+    size = _STR_LEN.unpack_from(buf, offset)[0]
+    if size == OTHER_STR:
+        return None
+    start = offset + _STR_LEN.size
+    return bytes(buf[start:start + size]).decode('utf-8', 'replace')
+
+
+class SharedStateExport:
+    # Mirrors a devstate.StateTable into a shared memory block. Rows above
+    # capacity are not exported. Writes come from StateTable.set (under the
+    # table lock), so there is a single writer per row.
+
+    def __init__(self, table, name=None, capacity=None, id_size=32, string_size=64):
+        self.table = table
+        self.capacity = capacity if capacity is not None else table.rows
+        self.id_size = id_size
+        self.string_size = string_size
+
+        self.fields, self.row_size = _field_layout(table.schema, id_size, string_size)
+        for field in self.fields:
+            if field['type'] == 'Enum':
+                field['codes'] = dict((item, i) for i, item in enumerate(field['items']))
+
+        meta = json.dumps({
+            'id_size':id_size,
+            'string_size':string_size,
+            'fields':[dict((k, v) for k, v in f.items() if k != 'codes') for f in self.fields],
+        }).encode('utf-8')
+        self.rows_offset = (_HEADER.size + len(meta) + 7) & ~7
+
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                size=max(1, self.rows_offset + self.capacity * self.row_size))
+        except FileExistsError:
+            raise FileExistsError('Shared memory "{0}" already exists, if it is left over '
+                'from a previous run remove it with: python shmstate.py -unlink {0}'.format(name))
+        self.name = self.shm.name
+        _exported.add(self.name)
+        buf = self.shm.buf
+        buf[_HEADER.size:_HEADER.size + len(meta)] = meta
+
+        with table.lock:
+            for row in range(min(table.rows, self.capacity)):
+                self.write_row(row)
+            table.exporter = self
+
+        # Header last, readers check the magic
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, 0, self.capacity,
+            self.row_size, self.rows_offset, len(meta))
+
+    def _row_start(self, row):
+        return self.rows_offset + row * self.row_size
+
+    def write_row(self, row):
+        # Called with table.lock held
+        if row >= self.capacity:
+            return
+        start = self._row_start(row)
+        buf = self.shm.buf
+        seq = _SEQ.unpack_from(buf, start)[0]
+        _SEQ.pack_into(buf, start, (seq + 1) & 0xffffffff)
+
+        device_id = _utf8(self.table.row_ids[row] or '', self.id_size)
+        buf[start + _SEQ.size:start + _SEQ.size + self.id_size] = device_id.ljust(self.id_size, b'\0')
+        for col, field in enumerate(self.fields):
+            data = _encode(field, self.table._get(row, col), self.string_size)
+            buf[start + field['offset']:start + field['offset'] + len(data)] = data
+
+        _SEQ.pack_into(buf, start, (seq + 2) & 0xffffffff)
+
+    def write(self, row, col, value):
+        if row >= self.capacity:
+            return
+        start = self._row_start(row)
+        buf = self.shm.buf
+        seq = _SEQ.unpack_from(buf, start)[0]
+        _SEQ.pack_into(buf, start, (seq + 1) & 0xffffffff)
+
+        field = self.fields[col]
+        data = _encode(field, value, self.string_size)
+        buf[start + field['offset']:start + field['offset'] + len(data)] = data
+
+        _SEQ.pack_into(buf, start, (seq + 2) & 0xffffffff)
+
+    def close(self, unlink=True):
+        if self.table.exporter is self:
+            self.table.exporter = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+            _exported.discard(self.name)
+
+
+class SharedStateReader:
+    def __init__(self, name):
+        self.shm = shared_memory.SharedMemory(name=name)
+        if name not in _exported:
+            # Attaching registers the block with this process' resource
+            # tracker, which would unlink it on exit. The writer owns it.
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            except Exception:
+                pass
+        self._read_header(name)
+
+    def _read_header(self, name):
+        buf = self.shm.buf
+        magic, version, _, self.capacity, self.row_size, self.rows_offset, meta_len = \
+            _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self.shm.close()
+            raise ValueError('"{}" is not a device state table'.format(name))
+
+        meta = json.loads(bytes(buf[_HEADER.size:_HEADER.size + meta_len]).decode('utf-8'))
+        self.id_size = meta['id_size']
+        self.string_size = meta['string_size']
+        self.fields = meta['fields']
+        self.names = [f['name'] for f in self.fields]
+
+    def _read_raw(self, row, retries):
+        start = self.rows_offset + row * self.row_size
+        end = start + self.row_size
+        buf = self.shm.buf
+        for _ in range(retries):
+            seq = _SEQ.unpack_from(buf, start)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = bytes(buf[start:end])
+            if _SEQ.unpack_from(buf, start)[0] == seq:
+                return data
+        raise TimeoutError('Row {} is busy'.format(row))
+
+    def read_row(self, row, retries=1000):
+        # Returns (device_id, {name: value}), device_id is None for rows not
+        # (yet) used
+        if not 0 <= row < self.capacity:
+            raise IndexError('Row {} out of range'.format(row))
+
+        data = self._read_raw(row, retries)
+        device_id = data[_SEQ.size:_SEQ.size + self.id_size].rstrip(b'\0').decode('utf-8', 'replace')
+        if not device_id:
+            return None, {}
+
+        values = dict((f['name'], _decode(f, data, self.string_size)) for f in self.fields)
+        return device_id, values
+
+    def snapshot(self):
+        # {device_id: {name: value}} of all used rows
+        ret = {}
+        for row in range(self.capacity):
+            device_id, values = self.read_row(row)
+            if device_id is not None:
+                ret[device_id] = values
+        return ret
+
+    def close(self):
+        self.shm.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Print VDev shared memory state table')
+    parser.add_argument('name', help='Shared memory name (run_vdev.py -shmstate)')
+    parser.add_argument('-unlink', action='store_true',
+        help='Remove the shared memory block, e.g. left over from a killed run_vdev.py')
+    args = parser.parse_args()
+
+    if args.unlink:
+        shm = shared_memory.SharedMemory(name=args.name)
+        shm.close()
+        shm.unlink()
+        sys.exit(0)
+
+    reader = SharedStateReader(args.name)
+    print(json.dumps(reader.snapshot(), indent=2))
+    reader.close()
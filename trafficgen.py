@@ -3,22 +3,27 @@ import imp
 import queue
 import streamrunner
 
+def load_gen_functions(stream_file_name):
+    module = imp.load_source('genmodules', stream_file_name)
+
+    gen_functions = []
+    for name in dir(module):
+        func = getattr(module, name)
+        if name.find('gen_')==0 and callable(func):
+            gen_functions.append(func)
+    return gen_functions
+
+
 class TrafficGen:
-    def __init__(self, stream_file_name, device_type):
-        self.queue = queue.Queue()
+    def __init__(self, stream_file_name, device_type, data_queue=None):
+        # data_queue e.g. pipeline.BoundedDataQueue, default is unbounded
+        self.queue = data_queue if data_queue is not None else queue.Queue()
         self.device_type = device_type
         self._load_stream_modules(stream_file_name)
     
     def _load_stream_modules(self, stream_file_name):
-        module = imp.load_source('genmodules', stream_file_name)
-
-        gen_functions = []
-        for name in dir(module):
-            func = getattr(module, name)
-            if name.find('gen_')==0 and callable(func):
-                gen_functions.append(func)
-        
-        
+        gen_functions = load_gen_functions(stream_file_name)
+
         stream_runners = []
         for func in gen_functions:
             stream_runners.append(
@@ -37,6 +42,10 @@ class TrafficGen:
         for sr in self.stream_runners:
             sr.end()
 
+        # Release streams blocked on a full bounded queue
+        if hasattr(self.queue, 'close'):
+            self.queue.close()
+
         for sr in self.stream_runners:
             sr.join()
 
@@ -0,0 +1,48 @@
+import collections
+import threading
+
+
+def freeze(value):
+    # Hashable form of a response dict. Type is kept with each value so
+    # True, 1 and 1.0 (which serialize differently) get different keys.
+    if isinstance(value, dict):
+        return (dict, tuple((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(freeze(v) for v in value))
+    return (value.__class__, value)
+
+
+class PayloadCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(size=len(self.entries), max_size=self.size,
+                        hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        hit_rate=(self.hits / lookups if lookups else 0.0))
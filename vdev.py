@@ -2,8 +2,19 @@ import paho.mqtt.client as mqtt
 import json
 from threading import Thread
 import time
-import base64
+import binascii
 import logging
+import functools
+import txcache
+import devschema
+import devstate
+import coalesce
+import pubpolicy
+import jsonstream
+import pipeline
+import cryptopool
+from wirecodec import WireCodec, get_shared_cipher
+import latency
 
 
 
@@ -15,6 +26,26 @@ C_ATTRIBUTE = 'attributeTypes'
 QM_SCAPE = '@$?@$'
 
 
+def validate_data_list(validators, data_list):
+    # Validates the "data" list of a platform message against compiled
+    # validators (devschema.compile_schema). Returns None if valid,
+    # otherwise the error message.
+    for x in data_list:
+        if not isinstance(x, dict):
+            return 'Invalid field in "{}" {}'.format(Vdev.DATA_FIELD, data_list)
+
+        for name, value in x.items():
+            check = validators.get(name)
+            if check is None:
+                return 'Type "{}" is not defined'.format(name)
+
+            error = check(value)
+            if error:
+                return error
+
+    return None
+
+
 class Vdev:
     DATA_FIELD = 'data'
 
@@ -23,15 +54,29 @@ class Vdev:
         device_id = None,
         enc_key = None,
         on_connect_tx_message="",
-        loop=False):
+        loop=False,
+        enc_block_cache=0,
+        tx_cache_size=0,
+        crypto_workers=0,
+        read_window=0,
+        delta=False,
+        full_refresh=0,
+        stream_decode=False,
+        stream_atomic=False,
+        max_inflight=0,
+        publish_qos=0,
+        track_latency=False):
 
         self.device_stopped = False
+        self.crypto = None
+        self.crypto_owner = False
         self.enable_subscribe = enable_subscribe 
 
         self.device_id = device_id
         self.enc_key = enc_key
         self.loop = loop
         self.enc_en = False
+        self.codec = WireCodec()
 
 
         self.process_config_files(platform_file, dev_file)
@@ -39,11 +84,70 @@ class Vdev:
         self.tx_done = False
         self.update_function=None
 
+        # Parse/validate/apply platform "data" entries one by one, with
+        # stream_atomic writes are applied only if all entries are valid
+        self.stream_decode = stream_decode or stream_atomic
+        self.stream_atomic = stream_atomic
+
+        self.publish_qos = publish_qos
+
+        # Max published but not acknowledged txmodule messages, see
+        # send_to_platform_from_queue
+        self.publish_window = None
+        if max_inflight:
+            self.publish_window = pipeline.InflightWindow(max_inflight, publish_qos)
+
+        # Publish -> on_publish latency histograms, replaced by the tracker
+        # of the connection with set_latency_tracker()
+        self.latency = None
+        if track_latency:
+            self.latency = latency.PublishLatency()
+
+        # Outbound response -> (json, wire payload) cache for repeated states
+        self.tx_cache = None
+        if tx_cache_size:
+            self.tx_cache = txcache.PayloadCache(tx_cache_size)
+
+        # Merge read-requests of platform message bursts into one response
+        self.read_coalescer = None
+        if read_window:
+            self.read_coalescer = coalesce.ReadCoalescer(read_window, self._respond_coalesced)
+
+        # Publish only changed fields, see publish_changes()
+        self.delta = None
+        self.full_refresh = full_refresh
+        self.timers_started = False
+        self.delta_stats = {'publishes':0, 'full_publishes':0, 'fields_sent':0, 'fields_skipped':0}
+        if delta and not self.is_stopped():
+            self.delta = devstate.DeltaTracker(publish_qos)
+            # Initial state was never published
+            self.delta.mark_all(len(self.device_schema.names))
+
+        # Publish policies of attributeTypes (deadband, min_interval, ...)
+        self.policy = None
+        if not self.is_stopped() and self.device_schema.policies:
+            self.policy = pubpolicy.PolicyFilter(self.device_schema.policies)
+
 
         if self.enc_en:
-            import pyDes
             key = (self.enc_key + '0'*8)[:8]
-            self.des = pyDes.des(key, pyDes.ECB, padmode=pyDes.PAD_PKCS5)
+            self.des = get_shared_cipher(key)
+            if enc_block_cache:
+                # ECB block memoization, shared by all devices with this key
+                self.des.setBlockCache(enc_block_cache)
+            self.codec = WireCodec(self.des)
+
+            if crypto_workers:
+                # Encode/decode in worker processes, see cryptopool
+                self.set_crypto_offload(cryptopool.CryptoOffload(crypto_workers))
+                self.crypto_owner = True
+
+    def set_crypto_offload(self, crypto):
+        # crypto is a cryptopool.CryptoOffload, may be shared by many devices.
+        # Only used when encryption is enabled.
+        if self.enc_en:
+            self.crypto = crypto
+            self.crypto_key = (self.enc_key + '0'*8)[:8]
 
     def process_config_files(self, platform_file, dev_file):
 
@@ -79,29 +183,15 @@ class Vdev:
         self.create_device_type_data_dict(device_type_list)
 
     def create_device_type_data_dict(self, device_type_list):
-        type_dic, data_dic = {}, {}
-        for type_field in device_type_list:
-            name, data_type = type_field['name'], type_field['type']
-
-            type_str = data_type
-            items = []
-
-            if isinstance(data_type, list):
-                type_str = 'Enum'
-                items = data_type
-            else:
-                type_str = data_type
-                items = ['WHAT?']
-
-            type_dic[name] = {'type':type_str, 'items':items}
+        # Type information is shared by all devices with the same device
+        # type (see devschema). Values are stored in the column table of the
+        # device type (see devstate), device_data_dic is a dict-like view.
+        schema = devschema.get_schema(device_type_list)
 
-            default_values = {'Boolean':False, 'String':'-', 'Enum':items[0], 'Number':0}
-
-            data_dic[name] = default_values[type_str]
-
-            self.device_type_dic = type_dic
-            self.device_data_dic = data_dic
-            self.device_attribute_type_list = device_type_list
+        self.device_schema = schema
+        self.device_type_dic = schema.type_dic
+        self.device_attribute_type_list = schema.attribute_types
+        self.device_data_dic = devstate.new_state(schema, self.device_id)
 
     def get_typelist(self, dev_dic):
         return dev_dic[C_ATTRIBUTE]
@@ -139,6 +229,20 @@ class Vdev:
                     if not isinstance(x, str):
                         self.error_report('{}. Invalid enum value'.format(error_message))
                         return False
+
+            # Optional publish policy
+            for key in devschema.POLICY_KEYS:
+                if not key in type_def:
+                    continue
+                value = type_def[key]
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                    self.error_report('{}. "{}" of "{}" should be a positive number'.format(
+                        error_message, key, type_def['name']))
+                    return False
+                if key in devschema.NUMBER_POLICY_KEYS and type_def['type'] != 'Number':
+                    self.error_report('{}. "{}" is only supported for Number ("{}")'.format(
+                        error_message, key, type_def['name']))
+                    return False
             
             
         return True
@@ -148,6 +252,9 @@ class Vdev:
 
     def stop(self):
         self.device_stopped = True
+        if self.crypto and self.crypto_owner:
+            self.crypto.shutdown()
+        self.crypto = None
     
     def is_stopped(self):
         return self.device_stopped
@@ -178,8 +285,30 @@ class Vdev:
 
         self.client.loop_start()
 
+        self._start_timers()
+
+    def attach_client(self, client):
+        # Use a connection owned by someone else (e.g. VdevFleet) instead
+        # of setup_mqtt(). Incoming messages are passed to mqtt_on_message.
+        self.client = client
+        self._start_timers()
+
     def mqtt_on_publish(self, client, userdata, mid):
         self.tx_done = True
+        if self.publish_window:
+            self.publish_window.ack(mid)
+        if self.latency:
+            self.latency.ack(mid)
+
+    def set_latency_tracker(self, tracker):
+        # Shared connections (VdevFleet, AsyncVdevRuntime) ack on their own
+        # tracker since mqtt_on_publish of the device is not called
+        self.latency = tracker
+
+    def get_latency_stats(self):
+        if not self.latency:
+            return None
+        return self.latency.get_device_stats(self.device_id)
 
     def mqtt_on_connect(self, client, userdata, flags, rc):
         if self.enable_subscribe:
@@ -195,10 +324,23 @@ class Vdev:
 
     def mqtt_on_message(self, client, userdata, msg):
 
-        payload = msg.payload
-        if self.is_enc_en():
-            payload = self._dec(msg.payload)
-        
+        if self.crypto:
+            self.crypto.submit(cryptopool.CryptoOffload.DECODE, self.crypto_key, msg.payload,
+                functools.partial(self._on_offload_decoded, msg))
+            return
+
+        try:
+            payload = self.codec.decode_text(msg.payload)
+        except (ValueError, binascii.Error) as e:
+            self.error_report('Invalid message from platform {} {}'.format(msg.payload, e))
+            return
+
+        self.process_platform_message(msg.topic, payload)
+
+    def _on_offload_decoded(self, msg, payload, error):
+        if error:
+            self.error_report('Invalid message from platform {} {}'.format(msg.payload, error))
+            return
         self.process_platform_message(msg.topic, payload)
 
     def get_p2d_topic(self):
@@ -232,85 +374,212 @@ class Vdev:
             # self.error_report('"DATA" field should be list {}'.format(data_list))
             # return ""
         
-        # All entries in data_list should be dict
-        for x in data_list:
-            if not isinstance(x, dict):
-                self.error_report('Invalid field in "{}}" {}'.format(Vdev.DATA_FIELD, data_list))
-                return ""
-        
-            # Check if all fields are defined in device type dict
-            for name, value in x.items():
-                if not name in self.device_type_dic:
-                    self.error_report('Type "{}" is not defined'.format(name))
-                    return ""
-                
-
-                if value == "?":
-                    # This is read-request, don't check the type
-                    continue
-
-                type_str = self.device_type_dic[name]['type']
-                items = self.device_type_dic[name]['items']
-
-
-                if type_str=='Boolean' and not isinstance(value, bool):
-                    self.error_report('Expect boolean for "{}" < "{}"'.format(name, value))
-                    return ""
-                
-                if type_str=='String' and not isinstance(value, str):
-                    self.error_report('Expect string for "{}" < "{}"'.format(name, value))
-                    return ""
+        # All entries in data_list should be dict with fields defined in
+        # device type dict, checked against the compiled schema
+        error = validate_data_list(self.device_schema.validators, data_list)
+        if error:
+            self.error_report(error)
+            return ""
 
-                if type_str=='Number' and not isinstance(value, (int, float)):
-                    self.error_report('Expect number for "{}" < "{}"'.format(name, value))
-                    return ""
-                
-                if type_str=='Enum' and not value in items:
-                    self.error_report('Invalid value for enum "{}" "{}" < "{}"'.format(name, items, value))
-                    return ""
-        
         return data_list
 
     def process_platform_message(self, topic, payload):
-        platform_data = self.decode_platform_message(payload)
+        if self.stream_decode:
+            read_request = self.apply_platform_message_stream(payload)
+        else:
+            read_request = None
+            platform_data = self.decode_platform_message(payload)
+            if platform_data:
+                read_request = self.apply_data_from_platform(platform_data)
 
-        if platform_data:
-            read_request = self.apply_data_from_platform(platform_data)
+        if read_request:
             if not self.loop:
-                self.apply_read_request(read_request)
+                if self.read_coalescer:
+                    self.read_coalescer.add(read_request)
+                else:
+                    self.apply_read_request(read_request)
+
+    def _respond_coalesced(self, read_request):
+        if not self.is_stopped():
+            self.apply_read_request(read_request)
+
+    def get_read_coalescing_stats(self):
+        if self.read_coalescer:
+            return self.read_coalescer.get_stats()
+        return None
     
     def apply_data_from_platform(self, data_list):
         read_request = set()
         for data in data_list:
-            for name, value in data.items():
+            self._apply_platform_entry(data, read_request)
                 
-                if value != '?':
-                    if value == QM_SCAPE:
-                        value = '?'
+        if self.update_function:
+            self.update_function(self.device_data_dic)
+
+        return read_request
+
+    def _apply_platform_entry(self, data, read_request, staged=None):
+        for name, value in data.items():
+
+            if value != '?':
+                if value == QM_SCAPE:
+                    value = '?'
+                if staged is None:
                     self.update_device_data(name, value)
+                else:
+                    staged[name] = value
 
-                read_request.add(name)
-                
-        if self.update_function:
+            read_request.add(name)
+
+    def apply_platform_message_stream(self, message):
+        # Streaming version of decode_platform_message + apply_data_from_platform:
+        # entries of "data" are parsed, validated and applied one at a time.
+        # On an error the entries before it stay applied (and are answered),
+        # unless stream_atomic is set: then writes are staged and only
+        # applied when the whole message is valid.
+        read_request = set()
+        staged = {} if self.stream_atomic else None
+        validators = self.device_schema.validators
+
+        try:
+            msg = message
+            # Message from MQTT is in byte-array format
+            if not isinstance(message, str):
+                msg = message.decode('utf-8')
+
+            for data in jsonstream.iter_field_items(msg, Vdev.DATA_FIELD):
+                error = validate_data_list(validators, [data])
+                if error:
+                    self.error_report(error)
+                    break
+                self._apply_platform_entry(data, read_request, staged)
+            else:
+                error = None
+        except KeyError:
+            error = '"{}" is missing in platform message {}'.format(Vdev.DATA_FIELD, message)
+            self.error_report(error)
+        except ValueError as e:
+            error = 'Invalid message from platform {} {}'.format(message, e)
+            self.error_report(error)
+
+        if error and staged is not None:
+            return None
+
+        if staged:
+            for name, value in staged.items():
+                self.update_device_data(name, value)
+
+        if read_request and self.update_function:
             self.update_function(self.device_data_dic)
 
         return read_request
 
     def update_device_data(self, name, value):
         logger.info('Write "{}"->"{}"'.format(name, value))
-        self.device_data_dic[name] = value
+        if self.delta:
+            old = self.device_data_dic[name]
+            self.device_data_dic[name] = value
+            # Marked after the write, see apply_read_request
+            if old != value or old.__class__ is not value.__class__:
+                self.delta.mark(self.device_schema.index[name])
+        else:
+            self.device_data_dic[name] = value
 
     def update_by_name_value_dict(self, update_dic):
         read_req=[]
         for name, value in update_dic.items():
             self.update_device_data(name, value)
             read_req.append(name)
-        self.apply_read_request(read_req)
+        if self.delta:
+            self.publish_changes()
+        else:
+            self.send_to_platform(dict(
+                (name, self.device_data_dic[name]) for name in read_req))
+
+    def publish_changes(self, full=False):
+        # Delta mode: publish the fields changed since the last acknowledged
+        # publish (all fields if full). Nothing is sent if nothing changed.
+        names = self.device_schema.names
+        if full:
+            self.delta.mark_all(len(names))
+        mask, token = self.delta.take()
+
+        stats = self.delta_stats
+        if not mask:
+            stats['fields_skipped'] += len(names)
+            return None
+
+        data_to_send = dict((name, self.device_data_dic[name])
+            for name in devstate.mask_names(names, mask))
+        if self.policy and not full:
+            filtered = self.policy.filter(data_to_send)
+            if len(filtered) != len(data_to_send):
+                # Suppressed values are not resent, held ones are sent by
+                # _policy_tick
+                self.delta.suppressed(token, devstate.names_mask(self.device_schema.index,
+                    [name for name in data_to_send if name not in filtered]))
+            data_to_send = filtered
+            if not data_to_send:
+                stats['fields_skipped'] += len(names)
+                return None
+
+        stats['publishes'] += 1
+        if full:
+            stats['full_publishes'] += 1
+        stats['fields_sent'] += len(data_to_send)
+        stats['fields_skipped'] += len(names) - len(data_to_send)
+
+        data_dic = self._create_response_dict([data_to_send])
+        return self._push_dict_to_platform(data_dic,
+            functools.partial(self.delta.sent, token))
+
+    def _start_timers(self):
+        if self.timers_started:
+            return
+        self.timers_started = True
+        if self.delta and self.full_refresh:
+            coalesce.call_later(self.full_refresh, self._full_refresh)
+        if self.policy and self.policy.tick:
+            coalesce.call_later(self.policy.tick, self._policy_tick)
+
+    def _full_refresh(self):
+        if not self.is_stopped():
+            self.publish_changes(full=True)
+            coalesce.call_later(self.full_refresh, self._full_refresh)
+
+    def _policy_tick(self):
+        # Held back (min_interval) values and max_silence heartbeats
+        if not self.is_stopped():
+            data = self.policy.due()
+            if data:
+                self._send_data(data)
+            coalesce.call_later(self.policy.tick, self._policy_tick)
+
+    def get_policy_stats(self):
+        if self.policy:
+            return self.policy.get_stats()
+        return None
+
+    def get_delta_stats(self):
+        if self.delta:
+            return dict(self.delta_stats)
+        return None
 
     def apply_read_request(self, read_request=None):
 
+        if read_request==None and self.delta:
+            self.publish_changes()
+            return
+
+        on_sent = None
+        if read_request and self.delta:
+            # The response publishes these fields, they are no longer dirty
+            mask = devstate.names_mask(self.device_schema.index, read_request)
+            self.delta.take_fields(mask)
+            on_sent = functools.partial(self.delta.sent_fields, mask)
+
         if read_request==None:
-            data_to_send = self.device_data_dic
+            data_to_send = self.device_data_dic.to_dict()
         else:
             data_to_send = dict([
                 (name, self.device_data_dic[name]) for name in read_request
@@ -318,7 +587,7 @@ class Vdev:
 
         data_dic = self._create_response_dict([data_to_send])
 
-        self._push_dict_to_platform(data_dic)
+        self._push_dict_to_platform(data_dic, on_sent)
 
     def _create_response_dict(self, data_list):
         data = data_list
@@ -327,16 +596,62 @@ class Vdev:
 
         return {Vdev.DATA_FIELD:data}
 
-    def _push_dict_to_platform(self, data_dic):
-        
-        jdata = json.dumps(data_dic)
-        
+    def _push_dict_to_platform(self, data_dic, on_sent=None):
+        # on_sent(MQTTMessageInfo) is called after publish, with None if
+        # the message could not be encoded
+        sent_at = time.monotonic() if self.latency else None
+
+        cached = None
+        if self.tx_cache:
+            cache_key = txcache.freeze(data_dic)
+            cached = self.tx_cache.get(cache_key)
+
+        if cached:
+            jdata, payload = cached
+        else:
+            jdata = json.dumps(data_dic)
+            if self.crypto:
+                # Published from the offload completion thread, in order
+                self.crypto.submit(cryptopool.CryptoOffload.ENCODE, self.crypto_key, jdata,
+                    functools.partial(self._on_offload_encoded, cache_key if self.tx_cache else None, jdata,
+                        on_sent=on_sent, sent_at=sent_at))
+                return None
+            payload = self.codec.encode_text(jdata)
+            if self.tx_cache:
+                self.tx_cache.put(cache_key, (jdata, payload))
+
+        if self.crypto:
+            # Keep the order with encodes still running in the pool
+            self.crypto.submit(cryptopool.CryptoOffload.READY, None, payload,
+                functools.partial(self._on_offload_encoded, None, jdata, on_sent=on_sent, sent_at=sent_at))
+            return None
+
         logger.debug('Send message to platform msg={}'.format(jdata))
-        
-        if self.is_enc_en():
-            jdata = self._enc(jdata)
 
-        return self.client.publish(self.get_d2p_topic(), jdata)
+        info = self._publish(payload, sent_at)
+        if on_sent:
+            on_sent(info)
+        return info
+
+    def _on_offload_encoded(self, cache_key, jdata, payload, error, on_sent=None, sent_at=None):
+        if error:
+            self.error_report('Failed to encode message {} {}'.format(jdata, error))
+            if on_sent:
+                on_sent(None)
+            return
+        if cache_key is not None:
+            self.tx_cache.put(cache_key, (jdata, payload))
+
+        logger.debug('Send message to platform msg={}'.format(jdata))
+        info = self._publish(payload, sent_at)
+        if on_sent:
+            on_sent(info)
+
+    def _publish(self, payload, sent_at=None):
+        info = self.client.publish(self.get_d2p_topic(), payload, self.publish_qos)
+        if sent_at is not None and self.latency:
+            self.latency.sent(info, sent_at, self.publish_qos, self.device_id)
+        return info
 
     def get_deviceid(self):
         return self.device_id
@@ -344,14 +659,16 @@ class Vdev:
     def get_data_dict(self):
         return self.device_data_dic
 
+    def get_tx_cache_stats(self):
+        if not self.tx_cache:
+            return None
+        return self.tx_cache.get_stats()
+
     def _enc(self, msg):
-        d = self.des.encrypt(msg)
-        x = base64.b64encode(d)
-        return x
+        return self.codec.encode_text(msg)
 
     def _dec(self, msg):
-        x = base64.b64decode(msg)
-        return self.des.decrypt(x)
+        return self.codec.decode_text(msg)
 
     def is_enc_en(self):
         return self.enc_en
@@ -362,8 +679,32 @@ class Vdev:
     def get_logger(self):
         return logger
     
+    def send_to_platform(self, data):
+        if self.policy:
+            data = self.policy.filter(data)
+            if not data:
+                return None
+        return self._send_data(data)
+
+    def _send_data(self, data):
+        # Publish counted by the -maxinflight window
+        data_dic = self._create_response_dict([data])
+        on_sent = self.publish_window.track if self.publish_window else None
+        return self._push_dict_to_platform(data_dic, on_sent)
+
+    def wait_for_publish_window(self):
+        # Blocks while max_inflight messages are not acknowledged. Not to be
+        # called from the MQTT network thread or an event loop.
+        if self.publish_window:
+            self.publish_window.wait()
+
+    def get_publish_window_stats(self):
+        if self.publish_window:
+            return self.publish_window.get_stats()
+        return None
+
     def send_to_platform_from_queue(self, queue):
         while True:
             qdata = queue.get()
-            data_dic = self._create_response_dict([qdata])
-            self._push_dict_to_platform(data_dic)
\ No newline at end of file
+            self.wait_for_publish_window()
+            self.send_to_platform(qdata)
\ No newline at end of file
@@ -0,0 +1,135 @@
+import json
+import logging
+
+from vdev import Vdev
+from mqttpool import MqttPool
+import cryptopool
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_fleet_identities(fleet_file):
+    # Fleet JSON file:
+    #   {
+    #     "devices": [{"device_id": "DEV1", "enc_key": "KEY1"}, ...],
+    #     "generate": {"count": 1000, "device_id": "FLT{:05d}", "enc_key": "KEY"}
+    #   }
+    # Both parts are optional, "enc_key" is optional in each entry.
+    with open(fleet_file, 'r') as f:
+        fleet_dic = json.load(f)
+
+    identities = []
+    for entry in fleet_dic.get('devices', []):
+        identities.append((entry['device_id'], entry.get('enc_key')))
+
+    gen = fleet_dic.get('generate')
+    if gen:
+        for i in range(gen['count']):
+            identities.append((gen['device_id'].format(i), gen.get('enc_key')))
+
+    return identities
+
+
+class VdevFleet:
+    # Many Vdev instances sharing MQTT connections. With one connection
+    # platform messages are received with a single wildcard subscription,
+    # with more connections devices are sharded over them (see MqttPool)
+    # and each connection subscribes to the topics of its devices. Incoming
+    # messages are routed to the device by the device-id in the topic.
+
+    def __init__(self, platform_file, dev_file, fleet_file,
+        loop=False,
+        crypto_workers=0,
+        connections=1,
+        track_latency=False,
+        **vdev_args):
+
+        self.loop = loop
+        self.connections = connections
+        self.track_latency = track_latency
+        self.devices = {}
+        self.unknown_messages = 0
+
+        self.crypto = None
+        if crypto_workers:
+            self.crypto = cryptopool.CryptoOffload(crypto_workers)
+
+        for device_id, enc_key in load_fleet_identities(fleet_file):
+            dev = Vdev(platform_file, dev_file,
+                device_id=device_id,
+                enc_key=enc_key,
+                loop=loop,
+                **vdev_args)
+
+            if dev.is_stopped():
+                continue
+
+            if self.crypto:
+                dev.set_crypto_offload(self.crypto)
+
+            self.devices[dev.get_deviceid()] = dev
+
+        with open(platform_file, 'r') as f:
+            self.plat_dic = json.load(f)
+
+        logger.info('Fleet with {} devices'.format(len(self.devices)))
+
+    def get_device(self, device_id):
+        return self.devices.get(device_id)
+
+    def get_p2d_topic(self):
+        return '/+/{}'.format('p2d' if not self.loop else 'd2p')
+
+    def connect(self):
+        self.pool = MqttPool(self.plat_dic, self.connections, self.mqtt_on_message,
+            track_latency=self.track_latency)
+
+        if self.connections == 1:
+            self.pool.subscribe_all(self.get_p2d_topic())
+
+        for device_id, dev in self.devices.items():
+            if self.connections > 1:
+                self.pool.subscribe(device_id, dev.get_p2d_topic())
+            conn = self.pool.get_connection(device_id)
+            if conn.latency:
+                dev.set_latency_tracker(conn.latency)
+            dev.attach_client(conn)
+
+        self.pool.connect()
+
+    def get_connection_stats(self):
+        return self.pool.get_stats()
+
+    def get_latency_stats(self):
+        if not self.track_latency:
+            return None
+        return self.pool.get_latency_stats()
+
+    def dump_latency(self, f):
+        for conn in self.pool.connections:
+            if conn.latency:
+                conn.latency.dump(f)
+
+    def mqtt_on_message(self, client, userdata, msg):
+        # Topic is /DEVICE_ID/p2d
+        parts = msg.topic.split('/')
+        dev = None
+        if len(parts) == 3:
+            dev = self.devices.get(parts[1])
+
+        if not dev:
+            self.unknown_messages += 1
+            return
+
+        dev.mqtt_on_message(client, userdata, msg)
+
+    def stop(self):
+        for dev in self.devices.values():
+            dev.stop()
+        if self.crypto:
+            self.crypto.shutdown()
+            self.crypto = None
+
+    def disconnect(self):
+        self.pool.disconnect()
@@ -38,8 +38,8 @@ class Vui:
         for field in type_list:
             data_name, data_type = field['name'], field['type']
             items = []
-            if isinstance(data_type, list):
-                items= data_type
+            if isinstance(data_type, (list, tuple)):
+                items= list(data_type)
                 data_type = 'Enum'
             
             value_var = tk.StringVar()
@@ -0,0 +1,74 @@
+import binascii
+import functools
+import threading
+
+
+# Cipher objects are shared by all devices with the same (8 byte) key.
+# pyDes keeps no per-call state in the cipher, so sharing between devices
+# and threads is safe. Key schedules are also cached inside pyDes.
+@functools.lru_cache(maxsize=4096)
+def get_shared_cipher(key):
+    import pyDes
+    return pyDes.des(key, pyDes.ECB, padmode=pyDes.PAD_PKCS5)
+
+
+# Scratch buffer of WireCodec, one per thread shared by all codecs: it only
+# holds a message during one encode/decode call
+_scratch = threading.local()
+
+
+class WireCodec:
+    # Converts between JSON text and the MQTT payload (DES-ECB with PKCS5
+    # padding, then base64). Ciphertext and plaintext are crypted in place
+    # in a per-thread buffer that is reused for every message, so each
+    # message is copied only where a stage needs its own output (utf-8,
+    # base64). Without a cipher the payload is the utf-8 JSON text.
+
+    BLOCK_SIZE = 8
+    PADDING = [bytes([n]) * n for n in range(BLOCK_SIZE + 1)]
+
+    def __init__(self, cipher=None):
+        self.cipher = cipher
+        if cipher:
+            import pyDes
+            self.encrypt_type = pyDes.des.ENCRYPT
+            self.decrypt_type = pyDes.des.DECRYPT
+
+    @staticmethod
+    def _buffer(size):
+        buf = getattr(_scratch, 'buf', None)
+        if buf is None or len(buf) < size:
+            buf = _scratch.buf = bytearray(max(size, 1024))
+        return memoryview(buf)
+
+    def encode_text(self, text):
+        raw = text.encode('utf-8')
+        if not self.cipher:
+            return raw
+
+        size = len(raw) + WireCodec.BLOCK_SIZE - len(raw) % WireCodec.BLOCK_SIZE
+        pad_len = size - len(raw)
+        buf = self._buffer(size)[:size]
+
+        # Text and PKCS5 padding are crypted in place
+        buf[:len(raw)] = raw
+        buf[len(raw):] = WireCodec.PADDING[pad_len]
+        self.cipher.crypt_into(buf, buf, self.encrypt_type)
+
+        return binascii.b2a_base64(buf, newline=False)
+
+    def decode_text(self, payload):
+        if not self.cipher:
+            if isinstance(payload, str):
+                return payload
+            return str(payload, 'utf-8')
+
+        raw = binascii.a2b_base64(payload)
+        size = len(raw)
+        if not size or size % WireCodec.BLOCK_SIZE:
+            raise ValueError('Invalid encrypted message length {}'.format(size))
+
+        buf = self._buffer(size)[:size]
+        self.cipher.crypt_into(raw, buf, self.decrypt_type)
+        pad_len = buf[size - 1]
+        return str(buf[:size - pad_len], 'utf-8')